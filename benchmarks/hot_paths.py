@@ -0,0 +1,229 @@
+"""
+Time the matching and connection hot paths on synthetic populations and
+write the results as JSON so runs can be compared over time. Each size
+runs in its own process so the module-level stores start empty.
+
+Usage: python benchmarks/hot_paths.py [--sizes 1000,10000,100000,1000000] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+import synthetic
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+    
+    async def send(self, *args, **kwargs):
+        return None
+
+
+class FakeChannel:
+    async def send(self, *args, **kwargs):
+        return None
+
+
+class FakeMessage:
+    def __init__(self, author):
+        self.author = author
+        self.channel = FakeChannel()
+    
+    async def add_reaction(self, emoji):
+        return None
+
+
+class FakeContext:
+    """Just enough of commands.Context to call a command handler directly"""
+    
+    def __init__(self, user_id):
+        self.author = FakeUser(user_id)
+        self.message = FakeMessage(self.author)
+        self.channel = self.message.channel
+    
+    async def send(self, *args, **kwargs):
+        return None
+
+
+def create_offline_bot():
+    """A bot whose Discord lookups are answered locally"""
+    bot = main.create_bot(main.NullStorage())
+    
+    async def fetch_user(user_id):
+        return FakeUser(user_id)
+    
+    bot.fetch_user = fetch_user
+    return bot
+
+
+def summarize(samples_ns):
+    samples_ns = sorted(samples_ns)
+    
+    def percentile(fraction):
+        return samples_ns[min(len(samples_ns) - 1, int(fraction * len(samples_ns)))] / 1000
+    
+    return {
+        'ops': len(samples_ns),
+        'mean_us': sum(samples_ns) / len(samples_ns) / 1000,
+        'p50_us': percentile(0.50),
+        'p95_us': percentile(0.95),
+        'p99_us': percentile(0.99),
+    }
+
+
+def time_each(function, arguments):
+    samples = []
+    for args in arguments:
+        start = time.perf_counter_ns()
+        function(*args)
+        samples.append(time.perf_counter_ns() - start)
+    return summarize(samples)
+
+
+async def time_each_async(function, arguments):
+    samples = []
+    for args in arguments:
+        start = time.perf_counter_ns()
+        await function(*args)
+        samples.append(time.perf_counter_ns() - start)
+    return summarize(samples)
+
+
+def connected_name_pairs(rng, count):
+    """(user_id, partner name) pairs for users who have at least one connection"""
+    keys = list(main.active_connections.keys())
+    pairs = []
+    for key in rng.sample(keys, min(count, len(keys))):
+        user_id, other_id = key if rng.random() < 0.5 else key[::-1]
+        pairs.append((user_id, main.user_data[other_id].name))
+    return pairs
+
+
+def create_and_delete(user_id, person):
+    main.register_profile(user_id, person)
+    main.delete_profile(user_id)
+
+
+async def run_handlers(rng, size, ops):
+    bot = create_offline_bot()
+    findmatch = bot.get_command('findmatch').callback
+    msg = bot.get_command('msg').callback
+    
+    results = {
+        'findmatch_command': await time_each_async(
+            findmatch, [(FakeContext(rng.randint(1, size)),) for _ in range(ops)]
+        ),
+        'msg_command': await time_each_async(
+            lambda ctx, name: msg(ctx, args=f'"{name}" hello'),
+            [(FakeContext(user_id), name) for user_id, name in connected_name_pairs(rng, ops)]
+        ),
+    }
+    await main.close_http_session()
+    return results
+
+
+def run_size(size, seed):
+    """Populate size users and time every hot path, returning a results dict"""
+    start = time.perf_counter()
+    synthetic.populate(size, seed)
+    populate_seconds = time.perf_counter() - start
+    
+    rng = random.Random(seed)
+    user_ids = range(1, size + 1)
+    people = main.user_data
+    
+    results = {
+        'users': size,
+        'connections': len(main.active_connections),
+        'populate_seconds': populate_seconds,
+        'calculate_match_score': time_each(
+            main.calculate_match_score,
+            [(people[rng.choice(user_ids)], people[rng.choice(user_ids)]) for _ in range(10_000)]
+        ),
+        'find_matches': time_each(
+            main.compute_matches, [(rng.choice(user_ids),) for _ in range(200)]
+        ),
+        'find_matches_cached': time_each(
+            main.find_matches, [(user_id,) for user_id in rng.sample(user_ids, 200) for _ in range(5)]
+        ),
+        'get_user_connections': time_each(
+            main.get_user_connections, [(rng.choice(user_ids),) for _ in range(10_000)]
+        ),
+        'resolve_message_target': time_each(
+            lambda user_id, name: main.resolve_message_target(user_id, main.name_index, name),
+            connected_name_pairs(rng, 10_000)
+        ),
+        'profile_create_delete': time_each(
+            create_and_delete,
+            [(size + offset + 1, person) for offset, (_, person) in enumerate(synthetic.generate_people(1000, seed + 1))]
+        ),
+    }
+    results.update(asyncio.run(run_handlers(rng, size, 50)))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--matcher", default="python", help="GAMETALK_MATCHER engine to benchmark")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.size:
+        # Worker process: one size, JSON on stdout
+        main.configure_matcher(args.matcher)
+        print(json.dumps(run_size(args.size, args.seed)))
+        return
+    
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'matcher': args.matcher,
+        'seed': args.seed,
+        'results': [],
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        print(f"Benchmarking {size} users...", file=sys.stderr)
+        worker = subprocess.run(
+            [sys.executable, __file__, "--size", str(size), "--seed", str(args.seed), "--matcher", args.matcher],
+            capture_output=True, text=True, check=True
+        )
+        report['results'].append(json.loads(worker.stdout.strip().splitlines()[-1]))
+    
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,75 @@
+"""
+Compare the incremental matcher with full recomputation as the pool
+grows: what one new profile costs to push into everyone's top lists,
+and what a !findmatch lookup costs with each engine.
+
+Usage: python benchmarks/incremental_matching.py [--sizes 1000,2000,5000,10000] [--samples N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+import synthetic
+
+
+def timed(function, arguments):
+    """Mean microseconds per call"""
+    start = time.perf_counter()
+    for args in arguments:
+        function(*args)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def measure(size, samples, seed):
+    main.configure_matcher('python')
+    for user_id, person in synthetic.generate_people(size, seed):
+        main.user_data[user_id] = person
+        main.index_profile(user_id, person.name, person.games, person.location)
+    
+    # Full recompute of one user's matches
+    user_ids = list(range(1, size + 1, max(1, size // samples)))[:samples]
+    recompute = timed(main.compute_matches, [(user_id,) for user_id in user_ids])
+    
+    # Build the incremental state once (every user read once), then time updates and reads
+    main.configure_matcher('incremental')
+    engine = main.match_engine
+    start = time.perf_counter()
+    for user_id in range(1, size + 1):
+        engine.find_matches(user_id)
+    build = time.perf_counter() - start
+    
+    lookup = timed(engine.find_matches, [(user_id,) for user_id in user_ids])
+    new_people = list(synthetic.generate_people(samples, seed + 1))
+    insert = timed(
+        lambda user_id, person: engine.add(user_id, person.game_ids, person.station_id),
+        [(size + user_id, person) for user_id, person in new_people]
+    )
+    delete = timed(engine.remove, [(size + user_id,) for user_id, _ in new_people])
+    return recompute, build, lookup, insert, delete
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,2000,5000,10000")
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    print(f"{'users':>8} {'recompute':>12} {'lookup':>10} {'insert':>12} {'delete':>12} {'build':>9}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        main.user_data = main.ProfileStore()
+        main.game_index.clear()
+        main.station_index.clear()
+        main.name_index.clear()
+        recompute, build, lookup, insert, delete = measure(size, args.samples, args.seed)
+        print(f"{size:>8} {recompute:>10.1f}us {lookup:>8.1f}us {insert:>10.1f}us {delete:>10.1f}us {build:>8.1f}s")
+    print("recompute: full find_matches for one user; lookup: incremental find_matches;")
+    print("insert/delete: pushing one profile change into everyone affected; build: initial fill")
+
+
+if __name__ == "__main__":
+    main_cli()
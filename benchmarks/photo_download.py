@@ -0,0 +1,101 @@
+"""
+Measure photo download throughput and peak RSS against a local HTTP
+server, for the pooled streaming download_photo and for the old
+session-per-photo, read-everything version.
+
+Usage: python benchmarks/photo_download.py [--photos N] [--size-kb KB] [--concurrency C]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import aiohttp
+from aiohttp import web
+
+import main
+
+
+async def legacy_download_photo(url, user_id):
+    """download_photo as it was before the shared session and streaming"""
+    try:
+        os.makedirs(main.PHOTO_DIR, exist_ok=True)
+        
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    filepath = f"{main.PHOTO_DIR}/{user_id}.jpg"
+                    with open(filepath, 'wb') as f:
+                        f.write(await resp.read())
+                    return filepath
+    except Exception as e:
+        print(f"Error downloading photo: {e}")
+    return None
+
+
+async def run(mode, photos, size_kb, concurrency):
+    body = os.urandom(size_kb * 1024)
+    
+    async def handler(request):
+        return web.Response(body=body, content_type="image/jpeg")
+    
+    app = web.Application()
+    app.router.add_get("/photo/{user_id}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    
+    download = main.download_photo if mode == "pooled" else legacy_download_photo
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def fetch(user_id):
+        async with semaphore:
+            return await download(f"http://127.0.0.1:{port}/photo/{user_id}", user_id)
+    
+    with tempfile.TemporaryDirectory() as photo_dir:
+        main.PHOTO_DIR = photo_dir
+        start = time.perf_counter()
+        results = await asyncio.gather(*(fetch(user_id) for user_id in range(photos)))
+        elapsed = time.perf_counter() - start
+    
+    await main.close_http_session()
+    await runner.cleanup()
+    
+    failed = sum(1 for result in results if result is None)
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:>7}: {photos / elapsed:8.1f} photos/s, peak RSS {peak_rss_mb:.1f} MB, {failed} failed")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--photos", type=int, default=500)
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mode", choices=["pooled", "legacy"])
+    args = parser.parse_args()
+    
+    if args.mode:
+        asyncio.run(run(args.mode, args.photos, args.size_kb, args.concurrency))
+        return
+    
+    # Peak RSS is per process, so measure each mode in its own
+    print(f"{args.photos} photos of {args.size_kb} KB, {args.concurrency} at a time")
+    for mode in ("legacy", "pooled"):
+        subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--photos", str(args.photos),
+             "--size-kb", str(args.size_kb), "--concurrency", str(args.concurrency)],
+            check=True
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
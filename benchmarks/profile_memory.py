@@ -0,0 +1,72 @@
+"""
+Measure memory per profile for the old dict-based Person versus the
+slotted Person with interned game and station ids.
+
+Usage: python benchmarks/profile_memory.py [--profiles N]
+"""
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+GAMES = [
+    "Valorant", "League of Legends", "Minecraft", "Dota 2", "Counter-Strike 2",
+    "Apex Legends", "Fortnite", "Overwatch 2", "Genshin Impact", "Rocket League",
+    "Mobile Legends", "PUBG", "Roblox", "Honkai: Star Rail", "Stardew Valley",
+]
+
+
+class LegacyPerson:
+    """Person as it was before slots and interning"""
+    def __init__(self, name="", age=0, games=None, location="", bio="", photo_url=None):
+        self.name = name
+        self.age = age
+        self.games = games if games else []
+        self.location = location
+        self.bio = bio
+        self.photo_url = photo_url
+
+
+def make_fields(rng, index):
+    # Each profile parses its games and station out of its own Discord
+    # message/interaction, so the strings are fresh objects, not shared ones
+    games = ["".join(list(game)) for game in rng.sample(GAMES, rng.randint(1, 5))]
+    location = "".join(list(rng.choice(main.ALL_MRT_STATIONS)))
+    return (f"Player{index}", rng.randint(13, 40), games, location, f"Bio of player {index}", None)
+
+
+def measure(person_class, count, seed):
+    """Return the traced bytes per profile after creating count profiles"""
+    rng = random.Random(seed)
+    
+    tracemalloc.start()
+    people = [person_class(*make_fields(rng, i)) for i in range(count)]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    del people
+    return allocated / count
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profiles", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    legacy = measure(LegacyPerson, args.profiles, args.seed)
+    slotted = measure(main.Person, args.profiles, args.seed)
+    
+    print(f"Profiles:          {args.profiles}")
+    print(f"Before (dict):     {legacy:.0f} bytes/profile")
+    print(f"After (slots+ids): {slotted:.0f} bytes/profile")
+    print(f"Saved:             {100 * (1 - slotted / legacy):.1f}%")
+
+
+if __name__ == "__main__":
+    main_cli()
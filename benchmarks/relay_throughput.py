@@ -0,0 +1,117 @@
+"""
+Measure relayed chat throughput against a fake Discord API that allows
+a fixed number of sends per second and answers the rest with 429s, for
+the MessageRelay and for the old inline send-per-message.
+
+Usage: python benchmarks/relay_throughput.py [--messages N] [--recipients R] [--rate PER_SEC]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import discord
+
+import main
+
+
+class FakeAPI:
+    """A send endpoint with latency and a fixed-window rate limit"""
+    
+    def __init__(self, rate, latency):
+        self.rate = rate
+        self.latency = latency
+        self.window_start = 0.0
+        self.window_sends = 0
+        self.calls = 0
+        self.rate_limited = 0
+    
+    async def send(self, recipient_id, content):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        now = time.perf_counter()
+        if now - self.window_start >= 1.0:
+            self.window_start = now
+            self.window_sends = 0
+        if self.window_sends >= self.rate:
+            self.rate_limited += 1
+            raise discord.RateLimited(1.0 - (now - self.window_start))
+        self.window_sends += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+async def run_inline(api, traffic):
+    """The old path: every message is its own send, failures are reported back"""
+    latencies = []
+    failed = 0
+    
+    async def relay(recipient_id, content, sent_at):
+        nonlocal failed
+        try:
+            await api.send(recipient_id, content)
+            latencies.append(time.perf_counter() - sent_at)
+        except Exception:
+            failed += 1
+    
+    await asyncio.gather(*(relay(r, c, time.perf_counter()) for r, c in traffic))
+    return latencies, failed
+
+
+async def run_relay(api, traffic):
+    relay = main.MessageRelay(api.send, max_queue=len(traffic))
+    relay.start()
+    latencies = []
+    failed = 0
+    
+    async def wait(delivery, sent_at):
+        nonlocal failed
+        try:
+            await delivery
+            latencies.append(time.perf_counter() - sent_at)
+        except Exception:
+            failed += 1
+    
+    await asyncio.gather(*(wait(relay.submit(r, c), time.perf_counter()) for r, c in traffic))
+    return latencies, failed
+
+
+def measure(name, runner, args):
+    rng = random.Random(args.seed)
+    traffic = [(rng.randrange(args.recipients), f"💬 **Message from user:**\nmessage {i}")
+               for i in range(args.messages)]
+    api = FakeAPI(args.rate, args.latency / 1000)
+    start = time.perf_counter()
+    latencies, failed = asyncio.run(runner(api, traffic))
+    elapsed = time.perf_counter() - start
+    print(f"{name}:")
+    print(f"  delivered {len(latencies)}/{args.messages} ({failed} failed) in {elapsed:.2f}s, "
+          f"{len(latencies) / elapsed:.0f} msgs/s")
+    print(f"  API calls {api.calls} ({api.rate_limited} rate limited)")
+    print(f"  delivery latency p50 {percentile(latencies, 0.5) * 1000:.0f}ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=50)
+    parser.add_argument("--rate", type=int, default=50, help="sends allowed per second")
+    parser.add_argument("--latency", type=float, default=50, help="API latency in ms")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    measure("Before (inline send)", run_inline, args)
+    measure("After (MessageRelay)", run_relay, args)
+
+
+if __name__ == "__main__":
+    main_cli()
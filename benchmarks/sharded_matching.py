@@ -0,0 +1,83 @@
+"""
+Measure !findmatch scoring throughput and event loop lag for the in-process
+Python matcher and for the sharded process-pool matcher at several shard
+counts, with many queries in flight at once.
+
+Usage: python benchmarks/sharded_matching.py [--users N] [--queries N] [--shards 1,2,4]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+import synthetic
+
+
+async def run_queries(user_ids, concurrency):
+    """Run find_matches_async for every user, returning (queries/s, max loop lag in ms)"""
+    lags = []
+    running = True
+    
+    async def ticker():
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def query(user_id):
+        async with semaphore:
+            await main.find_matches_async(user_id)
+    
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(query(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - start
+    running = False
+    await tick
+    return len(user_ids) / elapsed, max(lags, default=0) * 1000
+
+
+def measure(engine, user_ids, concurrency):
+    main.match_cache.clear()
+    main.match_engine = engine
+    if engine is not None:
+        for user_id, person in main.user_data.items():
+            engine.load(user_id, person.game_ids, person.station_id)
+        # Let the shards take their snapshot before timing
+        engine.find_matches(user_ids[0])
+    try:
+        return asyncio.run(run_queries(user_ids, concurrency))
+    finally:
+        main.shutdown_match_engine()
+        main.match_engine = None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--shards", default=",".join(str(2 ** i) for i in range(4) if 2 ** i <= (os.cpu_count() or 1) * 2))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    
+    synthetic.populate(args.users, args.seed)
+    step = max(1, args.users // args.queries)
+    user_ids = list(range(1, args.users + 1, step))[:args.queries]
+    
+    print(f"{args.users} users, {len(user_ids)} queries, {args.concurrency} in flight, {os.cpu_count()} CPUs")
+    rate, lag = measure(None, user_ids, args.concurrency)
+    print(f"python (in loop):  {rate:8.1f} queries/s, max loop lag {lag:7.1f}ms")
+    for shards in (int(shards) for shards in args.shards.split(",")):
+        rate, lag = measure(main.ShardedMatcher(shards), user_ids, args.concurrency)
+        print(f"{f'sharded x{shards}:':<19}{rate:8.1f} queries/s, max loop lag {lag:7.1f}ms")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,90 @@
+"""
+Synthetic GameTalk data for the benchmarks: profiles whose games follow a
+Zipf popularity curve, stations drawn from ALL_MRT_STATIONS, and a random
+connection graph that respects MAX_CONNECTIONS.
+"""
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+FIRST_NAMES = [
+    "Alex", "Ben", "Chloe", "Daniel", "Ethan", "Faith", "Grace", "Hui Min", "Isaac", "Jun Jie",
+    "Kai", "Lucas", "Mei Ling", "Nicholas", "Olivia", "Priya", "Qi Xuan", "Rachel", "Siti", "Tom",
+    "Umar", "Vanessa", "Wei Jie", "Xin Yi", "Yusuf", "Zara",
+]
+LAST_NAMES = [
+    "Tan", "Lim", "Lee", "Ng", "Ong", "Wong", "Goh", "Chua", "Chan", "Koh",
+    "Teo", "Ang", "Yeo", "Tay", "Ho", "Low", "Toh", "Sim", "Chong", "Kumar",
+]
+
+
+def game_catalogue(size=500):
+    return [f"Game {rank:04d}" for rank in range(1, size + 1)]
+
+
+def zipf_weights(size, exponent=1.1):
+    return [1 / rank ** exponent for rank in range(1, size + 1)]
+
+
+def generate_people(count, seed=1, games=500, exponent=1.1, max_games=5):
+    """Yield (user_id, Person) pairs; game popularity follows a Zipf distribution"""
+    rng = random.Random(seed)
+    catalogue = game_catalogue(games)
+    cumulative = []
+    total = 0.0
+    for weight in zipf_weights(games, exponent):
+        total += weight
+        cumulative.append(total)
+    
+    for user_id in range(1, count + 1):
+        picked = rng.choices(catalogue, cum_weights=cumulative, k=rng.randint(1, max_games))
+        yield user_id, main.Person(
+            f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            rng.randint(16, 40),
+            list(dict.fromkeys(picked)),
+            rng.choice(main.ALL_MRT_STATIONS),
+            "Looking for teammates!",
+            None,
+            None,
+        )
+
+
+def generate_connections(user_ids, seed=1, mean_degree=2.0, permanent_share=0.7):
+    """
+    Yield (connection_key, connection) pairs for a random graph with about
+    mean_degree connections per user, never more than MAX_CONNECTIONS.
+    """
+    rng = random.Random(seed)
+    user_ids = list(user_ids)
+    degrees = dict.fromkeys(user_ids, 0)
+    seen = set()
+    now = datetime.now()
+    
+    for _ in range(int(len(user_ids) * mean_degree / 2)):
+        user1_id, user2_id = rng.sample(user_ids, 2)
+        key = main.get_connection_key(user1_id, user2_id)
+        if key in seen or degrees[user1_id] >= main.MAX_CONNECTIONS or degrees[user2_id] >= main.MAX_CONNECTIONS:
+            continue
+        seen.add(key)
+        degrees[user1_id] += 1
+        degrees[user2_id] += 1
+        yield key, {
+            'timestamp': now - timedelta(minutes=rng.randint(0, 120)),
+            'user1_decision': None,
+            'user2_decision': None,
+            'permanent': rng.random() < permanent_share,
+        }
+
+
+def populate(count, seed=1):
+    """Fill the in-memory stores with count synthetic users and their connections"""
+    for user_id, person in generate_people(count, seed):
+        main.register_profile(user_id, person)
+        main.index_username(user_id, f"user{user_id}")
+    for key, connection in generate_connections(range(1, count + 1), seed):
+        main.active_connections[key] = connection
@@ -7,14 +7,323 @@ import requests
 import aiohttp
 from datetime import datetime, timedelta
 from discord.ui import View, Button, Select
-from math import radians, cos, sin, asin, sqrt
+from math import radians, cos, sin, asin, sqrt, ceil
+from array import array
+import sqlite3
+import threading
+import tempfile
+import time
+import hashlib
+import io
+import json
+import random
+import re
+import contextvars
+from bisect import bisect_left, insort
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from urllib.parse import parse_qs, urlsplit
+from collections import OrderedDict, deque
+from heapq import heappop, heappush, heapreplace, nsmallest
+from itertools import count
 
-# Store user data (in production, use a database)
-user_data = {}
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+class NullStorage:
+    """Storage backend that keeps nothing; profiles live only in memory"""
+    def load_user_ids(self):
+        return []
+    
+    def load_index_rows(self):
+        """Yield (user_id, name, games, location) for every stored profile"""
+        return []
+    
+    def load_profiles(self, user_ids):
+        return {}
+    
+    async def load_profiles_async(self, user_ids):
+        """load_profiles without blocking the event loop"""
+        return {}
+    
+    def load_connections(self):
+        return {}
+    
+    def load_photo_refs(self):
+        """Get {photo file: number of profiles using it}"""
+        return {}
+    
+    def save_profile(self, user_id, person):
+        pass
+    
+    def delete_profile(self, user_id):
+        pass
+    
+    def save_connection(self, connection_key, connection):
+        pass
+    
+    def delete_connection(self, connection_key):
+        pass
+    
+    async def flush(self):
+        pass
+    
+    def close(self):
+        pass
+
+class ConnectionStore:
+    """
+    Active connections keyed by get_connection_key tuples, with a per-user
+    adjacency map and permanent counts so per-user queries are O(degree)
+    instead of scanning every connection.
+    """
+    def __init__(self):
+        self.storage = NullStorage()
+        self._connections = {}
+        self._adjacency = {}  # {user_id: {connection_key: None, ...}} (dict keeps insertion order)
+        self._permanent_counts = {}  # {user_id: permanent connection count}
+        self._versions = {}  # {user_id: stamp of the last change to their connections}
+        self._clock = count(1)
+    
+    def __contains__(self, connection_key):
+        return connection_key in self._connections
+    
+    def __getitem__(self, connection_key):
+        return self._connections[connection_key]
+    
+    def __setitem__(self, connection_key, connection):
+        if connection_key in self._connections:
+            del self[connection_key]
+        
+        self._add(connection_key, connection)
+        self.storage.save_connection(connection_key, connection)
+    
+    def __delitem__(self, connection_key):
+        self._remove(connection_key)
+        self.storage.delete_connection(connection_key)
+    
+    def __len__(self):
+        return len(self._connections)
+    
+    def __iter__(self):
+        return iter(self._connections)
+    
+    def _add(self, connection_key, connection):
+        self._connections[connection_key] = connection
+        permanent = connection.get('permanent', False)
+        stamp = next(self._clock)
+        for user_id in connection_key:
+            self._adjacency.setdefault(user_id, {})[connection_key] = None
+            self._versions[user_id] = stamp
+            if permanent:
+                self._permanent_counts[user_id] = self._permanent_counts.get(user_id, 0) + 1
+    
+    def _remove(self, connection_key):
+        connection = self._connections.pop(connection_key)
+        permanent = connection.get('permanent', False)
+        stamp = next(self._clock)
+        for user_id in connection_key:
+            self._versions[user_id] = stamp
+            keys = self._adjacency[user_id]
+            del keys[connection_key]
+            if not keys:
+                del self._adjacency[user_id]
+            if permanent:
+                self._decrement_permanent(user_id)
+    
+    def _decrement_permanent(self, user_id):
+        count = self._permanent_counts[user_id] - 1
+        if count:
+            self._permanent_counts[user_id] = count
+        else:
+            del self._permanent_counts[user_id]
+    
+    def get(self, connection_key, default=None):
+        return self._connections.get(connection_key, default)
+    
+    def keys(self):
+        return self._connections.keys()
+    
+    def items(self):
+        return self._connections.items()
+    
+    def attach(self, storage):
+        """Use a storage backend and load the connections it holds"""
+        self.storage = storage
+        for connection_key, connection in storage.load_connections().items():
+            self._add(connection_key, connection)
+    
+    def record_decision(self, connection_key, user_id, decision):
+        """Record one user's keep/release decision on a trial connection"""
+        connection = self._connections[connection_key]
+        if user_id == connection_key[0]:
+            connection['user1_decision'] = decision
+        else:
+            connection['user2_decision'] = decision
+        self.storage.save_connection(connection_key, connection)
+    
+    def set_permanent(self, connection_key):
+        """Mark a trial connection as permanent"""
+        connection = self._connections[connection_key]
+        if connection.get('permanent', False):
+            return
+        connection['permanent'] = True
+        for user_id in connection_key:
+            self._permanent_counts[user_id] = self._permanent_counts.get(user_id, 0) + 1
+        self.storage.save_connection(connection_key, connection)
+    
+    def remove_user(self, user_id):
+        """Remove every connection a user is part of, returning the removed keys"""
+        keys = list(self._adjacency.get(user_id, ()))
+        for connection_key in keys:
+            del self[connection_key]
+        return keys
+    
+    def connections_of(self, user_id):
+        """Get all connection keys for a user"""
+        return list(self._adjacency.get(user_id, ()))
+    
+    def permanent_connections_of(self, user_id):
+        """Get the keys of a user's permanent connections"""
+        return [
+            key for key in self._adjacency.get(user_id, ())
+            if self._connections[key].get('permanent', False)
+        ]
+    
+    def connection_count(self, user_id):
+        return len(self._adjacency.get(user_id, ()))
+    
+    def version(self, user_id):
+        """Stamp that changes whenever a connection of user_id is added or removed"""
+        return self._versions.get(user_id, 0)
+    
+    def permanent_count(self, user_id):
+        return self._permanent_counts.get(user_id, 0)
+    
+    def trial_count(self, user_id):
+        return self.connection_count(user_id) - self.permanent_count(user_id)
+
+class ProfileStore:
+    """
+    User profiles keyed by Discord user id. Profiles are read from memory;
+    with a storage backend attached only the ids are known up front and
+    each Person is loaded the first time it is needed.
+    """
+    def __init__(self):
+        self.storage = NullStorage()
+        self._people = {}
+        self._known_ids = set()
+        self._versions = {}  # {user_id: stamp of the last change to their profile}
+        self._clock = count(1)
+    
+    def __contains__(self, user_id):
+        return user_id in self._known_ids
+    
+    def __getitem__(self, user_id):
+        person = self._people.get(user_id)
+        if person is None:
+            if user_id not in self._known_ids:
+                raise KeyError(user_id)
+            self.load_many([user_id])
+            person = self._people[user_id]
+        return person
+    
+    def __setitem__(self, user_id, person):
+        self._people[user_id] = person
+        self._known_ids.add(user_id)
+        self._versions[user_id] = next(self._clock)
+        self.storage.save_profile(user_id, person)
+    
+    def __delitem__(self, user_id):
+        if user_id not in self._known_ids:
+            raise KeyError(user_id)
+        self._known_ids.discard(user_id)
+        self._people.pop(user_id, None)
+        self._versions[user_id] = next(self._clock)
+        self.storage.delete_profile(user_id)
+    
+    def __len__(self):
+        return len(self._known_ids)
+    
+    def __iter__(self):
+        return iter(list(self._known_ids))
+    
+    def get(self, user_id, default=None):
+        if user_id not in self._known_ids:
+            return default
+        return self[user_id]
+    
+    def version(self, user_id):
+        """Stamp that changes whenever user_id's profile is saved or deleted"""
+        return self._versions.get(user_id, 0)
+    
+    def pop(self, user_id, default=None):
+        if user_id not in self._known_ids:
+            return default
+        person = self[user_id]
+        del self[user_id]
+        return person
+    
+    def items(self):
+        self.load_many(self._known_ids)
+        return list(self._people.items())
+    
+    def attach(self, storage):
+        """Use a storage backend; only the stored user ids are read now"""
+        self.storage = storage
+        self._known_ids.update(storage.load_user_ids())
+    
+    def load_many(self, user_ids):
+        """Load any of user_ids not yet in memory with a single batched read"""
+        missing = [
+            user_id for user_id in user_ids
+            if user_id in self._known_ids and user_id not in self._people
+        ]
+        if missing:
+            self._people.update(self.storage.load_profiles(missing))
+    
+    async def load_many_async(self, user_ids):
+        """load_many with the storage read on a worker thread"""
+        missing = [
+            user_id for user_id in user_ids
+            if user_id in self._known_ids and user_id not in self._people
+        ]
+        if not missing:
+            return
+        loaded = await self.storage.load_profiles_async(missing)
+        for user_id, person in loaded.items():
+            # Skip anyone saved or deleted while the read was running
+            if user_id in self._known_ids and user_id not in self._people:
+                self._people[user_id] = person
+
+# Store user data
+user_data = ProfileStore()
 # Store active connections with timestamps
-active_connections = {}  # {(user1_id, user2_id): {'timestamp': datetime, 'user1_decision': None, 'user2_decision': None}}
+active_connections = ConnectionStore()  # {(user1_id, user2_id): {'timestamp': datetime, 'user1_decision': None, 'user2_decision': None, 'permanent': False}}
 # Maximum connections per user
 MAX_CONNECTIONS = 5
+# How long a new connection stays on trial before users decide
+TRIAL_PERIOD = timedelta(minutes=30)
+# Inverted indexes used to generate match candidates
+game_index = {}  # {normalized game name: {user_id, ...}}
+station_index = {}  # {station_id: {user_id, ...}}
+# Name indexes used to resolve !msg and !dm targets
+name_index = {}  # {casefolded profile name: {user_id, ...}}
+username_index = {}  # {casefolded Discord username: {user_id, ...}}, profiled users only
+usernames = {}  # {user_id: Discord username as indexed}
+# Stations closer than this earn a distance bonus
+NEARBY_KM = 10
+# Optional matching engine (NumPy or incremental), see configure_matcher
+match_engine = None
 
 # Singapore MRT Stations with approximate coordinates (latitude, longitude)
 MRT_COORDINATES = {
@@ -248,18 +557,132 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     
     return round(c * r, 1)
 
+def distance_bonus(distance_km):
+    """Bonus match points for living close together (max 30 points)"""
+    if distance_km is None:
+        return 0
+    if distance_km < 2:
+        return 30
+    elif distance_km < 5:
+        return 20
+    elif distance_km < 10:
+        return 10
+    return 0
+
+# Station index: every station gets a small integer id (its position in
+# ALL_MRT_STATIONS) and all pairwise distances and distance bonuses are
+# computed once at import, so scoring a pair is a single array lookup.
+STATION_IDS = {station: i for i, station in enumerate(ALL_MRT_STATIONS)}
+STATION_COUNT = len(ALL_MRT_STATIONS)
+NO_DISTANCE = -1.0
+
+def build_station_matrices():
+    """Build flat N x N arrays of station distances (km) and distance bonuses"""
+    distances = array('d', [NO_DISTANCE]) * (STATION_COUNT * STATION_COUNT)
+    bonuses = array('B', bytes(STATION_COUNT * STATION_COUNT))
+    
+    for i, station1 in enumerate(ALL_MRT_STATIONS):
+        if station1 not in MRT_COORDINATES:
+            continue
+        lat1, lon1 = MRT_COORDINATES[station1]
+        
+        for j in range(i, STATION_COUNT):
+            station2 = ALL_MRT_STATIONS[j]
+            if station2 not in MRT_COORDINATES:
+                continue
+            lat2, lon2 = MRT_COORDINATES[station2]
+            
+            distance_km = haversine_distance(lat1, lon1, lat2, lon2)
+            bonus = distance_bonus(distance_km)
+            distances[i * STATION_COUNT + j] = distances[j * STATION_COUNT + i] = distance_km
+            bonuses[i * STATION_COUNT + j] = bonuses[j * STATION_COUNT + i] = bonus
+    
+    return distances, bonuses
+
+STATION_DISTANCES, STATION_BONUSES = build_station_matrices()
+# For each station id, the ids of all stations within NEARBY_KM (itself included)
+STATION_NEIGHBOURS = [
+    tuple(
+        j for j in range(STATION_COUNT)
+        if 0 <= STATION_DISTANCES[i * STATION_COUNT + j] < NEARBY_KM
+    )
+    for i in range(STATION_COUNT)
+]
+
+# Spatial grid over station coordinates for nearest-station lookups
+GRID_CELL_DEGREES = 0.01  # About 1.1 km
+KM_PER_DEGREE = 111.0  # Lower bound near the equator, good enough for Singapore
+
+def build_station_grid():
+    """Bucket stations by grid cell: {(lat cell, lon cell): [station, ...]}"""
+    grid = {}
+    for station, (lat, lon) in MRT_COORDINATES.items():
+        cell = (int(lat // GRID_CELL_DEGREES), int(lon // GRID_CELL_DEGREES))
+        grid.setdefault(cell, []).append(station)
+    return grid
+
+MRT_GRID = build_station_grid()
+
+def nearest_mrt_station(lat, lon, max_km=25):
+    """
+    Find the MRT station closest to a point by searching grid rings outward.
+    Returns (station, distance_km), or None if no station is within max_km.
+    """
+    cell_lat = int(lat // GRID_CELL_DEGREES)
+    cell_lon = int(lon // GRID_CELL_DEGREES)
+    lon_scale = cos(radians(lat))
+    max_ring = ceil(max_km / (GRID_CELL_DEGREES * KM_PER_DEGREE)) + 1
+    
+    best_station = None
+    best_squared = None
+    for ring in range(max_ring + 1):
+        for d_lat in range(-ring, ring + 1):
+            # Only the cells on the edge of this ring
+            d_lon_values = range(-ring, ring + 1) if abs(d_lat) == ring else (-ring, ring)
+            for d_lon in d_lon_values:
+                for station in MRT_GRID.get((cell_lat + d_lat, cell_lon + d_lon), ()):
+                    station_lat, station_lon = MRT_COORDINATES[station]
+                    dy = lat - station_lat
+                    dx = (lon - station_lon) * lon_scale
+                    squared = dx * dx + dy * dy
+                    if best_squared is None or squared < best_squared:
+                        best_station, best_squared = station, squared
+        
+        # Anything in a further ring is at least ring cells away
+        if best_station is not None and sqrt(best_squared) <= ring * GRID_CELL_DEGREES * lon_scale:
+            break
+    
+    if best_station is None:
+        return None
+    distance_km = haversine_distance(lat, lon, *MRT_COORDINATES[best_station])
+    if distance_km > max_km:
+        return None
+    return best_station, distance_km
+
+def get_station_id(station):
+    """Get the integer id of an MRT station, or None if unknown"""
+    return STATION_IDS.get(station)
+
+def station_distance(station_id1, station_id2):
+    """Distance in km between two station ids, or None if unavailable"""
+    distance_km = STATION_DISTANCES[station_id1 * STATION_COUNT + station_id2]
+    return None if distance_km < 0 else distance_km
+
+def station_bonus(station_id1, station_id2):
+    """Distance bonus points between two station ids"""
+    return STATION_BONUSES[station_id1 * STATION_COUNT + station_id2]
+
 def get_mrt_distance(station1, station2):
     """
     Calculate distance between two MRT stations.
     Returns distance in km or None if station not found.
     """
-    if station1 not in MRT_COORDINATES or station2 not in MRT_COORDINATES:
+    station_id1 = STATION_IDS.get(station1)
+    station_id2 = STATION_IDS.get(station2)
+    if station_id1 is None or station_id2 is None:
         return None
     
-    lat1, lon1 = MRT_COORDINATES[station1]
-    lat2, lon2 = MRT_COORDINATES[station2]
-    
-    return haversine_distance(lat1, lon1, lat2, lon2)
+    return station_distance(station_id1, station_id2)
 
 class MRTSelectView(View):
     """Dropdown menu for selecting MRT station"""
@@ -338,19 +761,310 @@ class MRTSelectView(View):
         await interaction.response.send_message(f"✅ You selected: **{self.selected_station}**", ephemeral=True)
         self.stop()
 
+# Interned game names: profiles share one copy of each spelling, and every
+# distinct game (compared with normalize_game) gets a small integer id that
+# scoring and the matching engines use
+GAME_SPELLINGS = {}  # {spelling: the shared copy of it}
+GAME_IDS = {}  # {normalized name: game_id}
+# Station id for profiles whose location isn't a known MRT station
+NO_STATION = -1
+
+def intern_game(game):
+    """Get the id for a game name, assigning a new one if needed"""
+    key = normalize_game(game)
+    game_id = GAME_IDS.get(key)
+    if game_id is None:
+        game_id = GAME_IDS[key] = len(GAME_IDS)
+    return game_id
+
 class Person:
-    def __init__(self, name="", age=0, games=None, location="", bio="", photo_url=None):
+    """
+    A gaming profile. Games are kept as the user spelled them (shared
+    interned strings) alongside their game ids, game_ids[i] being the id
+    of games[i]; the location is stored as a station id and the location
+    property gives back the name.
+    """
+    __slots__ = ('name', 'age', 'games', 'game_ids', 'station_id', 'bio', 'photo_url', 'photo_file')
+    
+    def __init__(self, name="", age=0, games=None, location="", bio="", photo_url=None, photo_file=None):
         self.name = name
         self.age = age
-        self.games = games if games else []
-        self.location = location
+        self.games = tuple(GAME_SPELLINGS.setdefault(game, game) for game in games) if games else ()
+        self.game_ids = tuple(intern_game(game) for game in self.games)
+        self.station_id = STATION_IDS.get(location, NO_STATION)
         self.bio = bio
         self.photo_url = photo_url
+        # Content-addressed thumbnail in PHOTO_DIR, see store_photo
+        self.photo_file = photo_file
+    
+    @property
+    def location(self):
+        return ALL_MRT_STATIONS[self.station_id] if self.station_id != NO_STATION else ""
+
+class SQLiteStorage(NullStorage):
+    """
+    SQLite storage backend with write-behind caching. Saves and deletes only
+    record the latest state per row in memory; flush() writes everything
+    pending in one batched transaction on a worker thread so the event loop
+    never waits on disk.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            location TEXT NOT NULL,
+            bio TEXT NOT NULL,
+            photo_url TEXT,
+            photo_file TEXT
+        );
+        CREATE TABLE IF NOT EXISTS profile_games (
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            game TEXT NOT NULL,
+            PRIMARY KEY (user_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS connections (
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            user1_decision TEXT,
+            user2_decision TEXT,
+            permanent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user1_id, user2_id)
+        );
+    """
+    # Statements are kept as constants so sqlite3's statement cache reuses
+    # the prepared versions across calls
+    PROFILE_COLUMNS = "user_id, name, age, location, bio, photo_url, photo_file"
+    UPSERT_PROFILE = f"INSERT OR REPLACE INTO profiles ({PROFILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    DELETE_PROFILE = "DELETE FROM profiles WHERE user_id = ?"
+    INSERT_GAME = "INSERT INTO profile_games VALUES (?, ?, ?)"
+    DELETE_GAMES = "DELETE FROM profile_games WHERE user_id = ?"
+    UPSERT_CONNECTION = "INSERT OR REPLACE INTO connections VALUES (?, ?, ?, ?, ?, ?)"
+    DELETE_CONNECTION = "DELETE FROM connections WHERE user1_id = ? AND user2_id = ?"
+    # SQLite's default limit on bound parameters per statement is 999
+    READ_BATCH_SIZE = 500
+    
+    def __init__(self, path):
+        self.path = path
+        self._pending = {}  # {('profile', user_id) or ('connection', key): latest row or None}
+        self._flush_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        
+        self._reader = sqlite3.connect(path)
+        self._reader.execute("PRAGMA journal_mode=WAL")
+        self._reader.execute("PRAGMA synchronous=NORMAL")
+        self._reader.executescript(self.SCHEMA)
+        columns = [row[1] for row in self._reader.execute("PRAGMA table_info(profiles)")]
+        if 'photo_file' not in columns:
+            self._reader.execute("ALTER TABLE profiles ADD COLUMN photo_file TEXT")
+            self._reader.commit()
+        # Reads for load_profiles_async run on worker threads with a
+        # connection of their own, one at a time under _read_lock, so a big
+        # prefetch never holds up a read on the event loop thread
+        self._thread_reader = sqlite3.connect(path, check_same_thread=False)
+        # The writer is only used from one flush at a time, on whichever
+        # worker thread asyncio.to_thread picks
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+    
+    def load_user_ids(self):
+        return [row[0] for row in self._reader.execute("SELECT user_id FROM profiles")]
+    
+    def load_index_rows(self):
+        games = {}
+        for user_id, game in self._reader.execute(
+            "SELECT user_id, game FROM profile_games ORDER BY user_id, position"
+        ):
+            games.setdefault(user_id, []).append(game)
+        
+        for user_id, name, location in self._reader.execute(
+            "SELECT user_id, name, location FROM profiles"
+        ):
+            yield user_id, name, games.get(user_id, []), location
+    
+    def load_profiles(self, user_ids):
+        return self._load_profiles(self._reader, list(user_ids))
+    
+    async def load_profiles_async(self, user_ids):
+        return await asyncio.to_thread(self._load_profiles_in_thread, list(user_ids))
+    
+    def _load_profiles_in_thread(self, user_ids):
+        with self._read_lock:
+            return self._load_profiles(self._thread_reader, user_ids)
+    
+    def _load_profiles(self, connection, user_ids):
+        people = {}
+        for start in range(0, len(user_ids), self.READ_BATCH_SIZE):
+            batch = user_ids[start:start + self.READ_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            
+            games = {}
+            for user_id, game in connection.execute(
+                f"SELECT user_id, game FROM profile_games WHERE user_id IN ({placeholders}) "
+                f"ORDER BY user_id, position",
+                batch
+            ):
+                games.setdefault(user_id, []).append(game)
+            
+            for user_id, name, age, location, bio, photo_url, photo_file in connection.execute(
+                f"SELECT {self.PROFILE_COLUMNS} FROM profiles WHERE user_id IN ({placeholders})", batch
+            ):
+                people[user_id] = Person(
+                    name, age, games.get(user_id, []), location, bio, photo_url, photo_file
+                )
+        return people
+    
+    def load_connections(self):
+        connections = {}
+        for user1_id, user2_id, timestamp, decision1, decision2, permanent in self._reader.execute(
+            "SELECT * FROM connections"
+        ):
+            connections[(user1_id, user2_id)] = {
+                'timestamp': datetime.fromisoformat(timestamp),
+                'user1_decision': decision1,
+                'user2_decision': decision2,
+                'permanent': bool(permanent)
+            }
+        return connections
+    
+    def load_photo_refs(self):
+        return dict(self._reader.execute(
+            "SELECT photo_file, COUNT(*) FROM profiles WHERE photo_file IS NOT NULL GROUP BY photo_file"
+        ))
+    
+    def save_profile(self, user_id, person):
+        self._pending[('profile', user_id)] = (
+            (user_id, person.name, person.age, person.location, person.bio,
+             person.photo_url, person.photo_file),
+            list(person.games)
+        )
+    
+    def delete_profile(self, user_id):
+        self._pending[('profile', user_id)] = None
+    
+    def save_connection(self, connection_key, connection):
+        self._pending[('connection', connection_key)] = (
+            connection_key[0],
+            connection_key[1],
+            connection['timestamp'].isoformat(),
+            connection['user1_decision'],
+            connection['user2_decision'],
+            int(connection.get('permanent', False))
+        )
+    
+    def delete_connection(self, connection_key):
+        self._pending[('connection', connection_key)] = None
+    
+    async def flush(self):
+        """Write all pending changes without blocking the event loop"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except BaseException:
+            # Put the batch back for the next flush; rows saved since are
+            # newer and win. Rewriting rows that did land is harmless.
+            for key, row in batch.items():
+                self._pending.setdefault(key, row)
+            raise
+    
+    def _write_batch(self, batch):
+        profile_upserts = []
+        game_rows = []
+        profile_ids = []
+        connection_upserts = []
+        connection_deletes = []
+        
+        for (kind, key), row in batch.items():
+            if kind == 'profile':
+                profile_ids.append((key,))
+                if row is not None:
+                    profile_row, games = row
+                    profile_upserts.append(profile_row)
+                    game_rows.extend((key, position, game) for position, game in enumerate(games))
+            elif row is None:
+                connection_deletes.append(key)
+            else:
+                connection_upserts.append(row)
+        
+        with self._flush_lock, self._writer:
+            self._writer.executemany(self.DELETE_GAMES, profile_ids)
+            self._writer.executemany(self.DELETE_PROFILE, profile_ids)
+            self._writer.executemany(self.UPSERT_PROFILE, profile_upserts)
+            self._writer.executemany(self.INSERT_GAME, game_rows)
+            self._writer.executemany(self.DELETE_CONNECTION, connection_deletes)
+            self._writer.executemany(self.UPSERT_CONNECTION, connection_upserts)
+    
+    async def run_flusher(self, interval=1.0):
+        """Flush pending writes every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                print(f"Error writing to database, will retry: {e}")
+    
+    def close(self):
+        """Write anything still pending and close the database"""
+        batch, self._pending = self._pending, {}
+        if batch:
+            self._write_batch(batch)
+        self._writer.close()
+        self._thread_reader.close()
+        self._reader.close()
+
+def load_storage(storage):
+    """Attach a storage backend and rebuild the in-memory indexes from it"""
+    user_data.attach(storage)
+    for user_id, name, games, location in storage.load_index_rows():
+        index_profile(user_id, name, games, location)
+        if match_engine is not None:
+            match_engine.load(
+                user_id,
+                [intern_game(game) for game in games],
+                STATION_IDS.get(location, NO_STATION)
+            )
+    active_connections.attach(storage)
+    photo_refs.update(storage.load_photo_refs())
+
+# IP geolocation lookups
+IPINFO_URL = "https://ipinfo.io/json"
+LOCATION_CACHE_TTL = 3600  # seconds
+location_cache = {}  # {url: (expires_at, (lat, lon, city, country))}
+http_session = None  # Shared aiohttp session, see get_http_session
+# Connection pool for the shared session
+HTTP_POOL_SIZE = 32
+HTTP_POOL_SIZE_PER_HOST = 8
+DNS_CACHE_SECONDS = 300
+
+def get_http_session():
+    """
+    Get the shared aiohttp session, creating it on first use. It lives as
+    long as the bot, so connections, DNS lookups and TLS sessions are reused.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_SECONDS
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 def get_location_by_ip():
     """Get location from IP address"""
     try:
-        response = requests.get("https://ipinfo.io/json")
+        response = requests.get(IPINFO_URL, timeout=5)
         data = response.json()
         
         if 'loc' in data:
@@ -364,82 +1078,2061 @@ def get_location_by_ip():
         print(f"Error connecting to the API: {e}")
         return None
 
-async def download_photo(url, user_id):
-    """Download and save user photo"""
-    try:
-        os.makedirs("user_photos", exist_ok=True)
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    content_type = resp.headers.get('content-type', '')
-                    ext = '.png'
-                    if 'jpeg' in content_type or 'jpg' in content_type:
-                        ext = '.jpg'
-                    elif 'gif' in content_type:
-                        ext = '.gif'
-                    elif 'webp' in content_type:
-                        ext = '.webp'
-                    
-                    filepath = f"user_photos/{user_id}{ext}"
-                    with open(filepath, 'wb') as f:
-                        f.write(await resp.read())
-                    
-                    return filepath
-    except Exception as e:
-        print(f"Error downloading photo: {e}")
-    return None
+async def fetch_location_by_ip(url=IPINFO_URL, timeout=5):
+    """
+    Get location from IP address without blocking the event loop.
+    Results are cached for LOCATION_CACHE_TTL seconds.
+    Returns (lat, lon, city, country) or None.
+    """
+    cached = location_cache.get(url)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    
+    try:
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            data = await resp.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f"Error connecting to the API: {e}")
+        return None
+    
+    if not isinstance(data, dict) or 'loc' not in data:
+        return None
+    
+    try:
+        lat, lon = map(float, data['loc'].split(','))
+    except (AttributeError, ValueError):
+        print(f"Unexpected location from the API: {data['loc']!r}")
+        return None
+    location = (lat, lon, data.get('city', 'Unknown'), data.get('country', 'Unknown'))
+    location_cache[url] = (time.monotonic() + LOCATION_CACHE_TTL, location)
+    return location
+
+async def fetch_nearest_mrt_by_ip(url=IPINFO_URL):
+    """Get (station, distance_km) for the MRT station nearest the IP location, or None"""
+    location = await fetch_location_by_ip(url)
+    if location is None:
+        return None
+    return nearest_mrt_station(location[0], location[1])
+
+# Where downloaded photos are stored
+PHOTO_DIR = "user_photos"
+# Largest photo we'll download
+MAX_PHOTO_BYTES = 8 * 1024 * 1024
+PHOTO_CHUNK_SIZE = 64 * 1024
+
+async def download_photo(url, user_id):
+    """
+    Download and save user photo. The body is streamed in chunks to a temp
+    file (disk writes happen off the event loop) and renamed into place
+    once complete, so a failed download never leaves a partial photo.
+    """
+    temp_path = None
+    try:
+        async with get_http_session().get(url) as resp:
+            if resp.status != 200:
+                return None
+            if resp.content_length is not None and resp.content_length > MAX_PHOTO_BYTES:
+                print(f"Error downloading photo: {resp.content_length} bytes is over the size limit")
+                return None
+            
+            content_type = resp.headers.get('content-type', '')
+            ext = '.png'
+            if 'jpeg' in content_type or 'jpg' in content_type:
+                ext = '.jpg'
+            elif 'gif' in content_type:
+                ext = '.gif'
+            elif 'webp' in content_type:
+                ext = '.webp'
+            
+            filepath = f"{PHOTO_DIR}/{user_id}{ext}"
+            temp_file, temp_path = await asyncio.to_thread(open_temp_photo)
+            size = 0
+            try:
+                async for chunk in resp.content.iter_chunked(PHOTO_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_PHOTO_BYTES:
+                        print(f"Error downloading photo: more than {MAX_PHOTO_BYTES} bytes")
+                        return None
+                    await asyncio.to_thread(temp_file.write, chunk)
+            finally:
+                await asyncio.to_thread(temp_file.close)
+            
+            await asyncio.to_thread(os.replace, temp_path, filepath)
+            temp_path = None
+            return filepath
+    except Exception as e:
+        print(f"Error downloading photo: {e}")
+    finally:
+        if temp_path is not None:
+            await asyncio.to_thread(remove_file, temp_path)
+    return None
+
+def open_temp_photo():
+    """Open a new temp file in PHOTO_DIR, returning (file, path)"""
+    os.makedirs(PHOTO_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=PHOTO_DIR, suffix=".part")
+    return os.fdopen(fd, 'wb'), path
+
+def remove_file(path):
+    """Delete a file if it exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Stored photos are thumbnails named by a hash of their content, so
+# identical photos are kept once; photo_refs counts the profiles using each
+THUMBNAIL_SIZE = 256
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_EXT = ".webp"
+photo_refs = {}  # {photo file: number of profiles using it}
+# File names collect_photo_garbage looks at; anything else in PHOTO_DIR is left alone
+LEGACY_PHOTO_NAME = re.compile(r"(\d+)\.(?:png|jpg|gif|webp)")  # download_photo's {user_id}{ext}
+THUMBNAIL_NAME = re.compile(r"[0-9a-f]{32}\.\w+")  # make_thumbnail's content hashes
+photo_cdn_urls = {}  # {photo file: Discord CDN URL of an earlier upload of it}
+# Re-upload a photo when its CDN URL expires within this many seconds
+CDN_URL_EXPIRY_MARGIN = 3600
+photo_pool = None  # Process pool for decoding/encoding photos, see get_photo_pool
+
+def get_photo_pool():
+    """Get the photo processing pool, creating it on first use"""
+    global photo_pool
+    if photo_pool is None:
+        photo_pool = ProcessPoolExecutor(max_workers=2)
+    return photo_pool
+
+def shutdown_photo_pool():
+    global photo_pool
+    if photo_pool is not None:
+        photo_pool.shutdown(wait=False, cancel_futures=True)
+    photo_pool = None
+
+def make_thumbnail(source_path, photo_dir):
+    """
+    Decode a downloaded photo, downscale it to THUMBNAIL_SIZE and re-encode
+    it, then store it in photo_dir under a hash of its content. Runs in the
+    photo process pool. Returns the stored file name.
+    """
+    if Image is None:
+        # Without Pillow the photo is stored as downloaded, still deduplicated
+        with open(source_path, 'rb') as f:
+            data = f.read()
+        ext = os.path.splitext(source_path)[1]
+    else:
+        with Image.open(source_path) as image:
+            image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            if thumbnail.mode not in ("RGB", "RGBA"):
+                thumbnail = thumbnail.convert("RGBA" if "transparency" in thumbnail.info else "RGB")
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, THUMBNAIL_FORMAT, quality=80, method=4)
+        data = buffer.getvalue()
+        ext = THUMBNAIL_EXT
+    
+    photo_file = hashlib.sha256(data).hexdigest()[:32] + ext
+    path = os.path.join(photo_dir, photo_file)
+    if not os.path.exists(path):
+        fd, temp_path = tempfile.mkstemp(dir=photo_dir, suffix=".part")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    return photo_file
+
+async def store_photo(url, user_id):
+    """
+    Download a photo and store its thumbnail. Returns the stored file name
+    (for Person.photo_file), or None if it couldn't be downloaded or decoded.
+    """
+    source_path = await download_photo(url, user_id)
+    if source_path is None:
+        return None
+    
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_photo_pool(), make_thumbnail, source_path, PHOTO_DIR)
+    except Exception as e:
+        print(f"Error processing photo: {e}")
+        return None
+    finally:
+        await asyncio.to_thread(remove_file, source_path)
+
+def retain_photo(photo_file):
+    """Count another profile using a stored photo"""
+    if photo_file:
+        photo_refs[photo_file] = photo_refs.get(photo_file, 0) + 1
+
+def release_photo(photo_file):
+    """Stop counting a profile's use of a stored photo, deleting it once unused"""
+    if not photo_file or photo_file not in photo_refs:
+        return
+    
+    photo_refs[photo_file] -= 1
+    if photo_refs[photo_file] <= 0:
+        del photo_refs[photo_file]
+        photo_cdn_urls.pop(photo_file, None)
+        path = os.path.join(PHOTO_DIR, photo_file)
+        try:
+            asyncio.get_running_loop().run_in_executor(None, remove_file, path)
+        except RuntimeError:
+            remove_file(path)
+
+def cdn_url_expired(url):
+    """Check the hex expiry timestamp Discord puts in the ex parameter of CDN URLs"""
+    expires = parse_qs(urlsplit(url).query).get('ex')
+    if not expires:
+        return False
+    try:
+        return int(expires[0], 16) - CDN_URL_EXPIRY_MARGIN <= time.time()
+    except ValueError:
+        return True
+
+def cached_photo_url(photo_file):
+    """Get a still-valid CDN URL for an uploaded photo, or None"""
+    url = photo_cdn_urls.get(photo_file)
+    if url is not None and cdn_url_expired(url):
+        del photo_cdn_urls[photo_file]
+        url = None
+    return url
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+async def send_profile_embed(destination, embed, person):
+    """
+    Send an embed with person's stored photo as its thumbnail. The first
+    time a photo is shown it is uploaded as an attachment and the CDN URL
+    Discord gives it is cached, so later embeds just link to it until it
+    goes stale and gets uploaded again. Falls back to the original photo
+    URL if there is no stored photo.
+    """
+    photo_file = person.photo_file
+    if photo_file:
+        url = cached_photo_url(photo_file)
+        if url is not None:
+            embed.set_thumbnail(url=url)
+            return await destination.send(embed=embed)
+        
+        try:
+            data = await asyncio.to_thread(read_file, os.path.join(PHOTO_DIR, photo_file))
+        except OSError:
+            data = None
+        
+        if data is not None:
+            embed.set_thumbnail(url=f"attachment://{photo_file}")
+            message = await destination.send(embed=embed, file=discord.File(io.BytesIO(data), filename=photo_file))
+            
+            if message.embeds and message.embeds[0].thumbnail.url:
+                photo_cdn_urls[photo_file] = message.embeds[0].thumbnail.url
+            elif message.attachments:
+                photo_cdn_urls[photo_file] = message.attachments[0].url
+            return message
+    
+    if person.photo_url:
+        embed.set_thumbnail(url=person.photo_url)
+    return await destination.send(embed=embed)
+
+def collect_photo_garbage(storage):
+    """
+    Clean up PHOTO_DIR at startup: delete leftover temp files and
+    thumbnails no profile uses, and turn per-user downloads from before
+    thumbnails into thumbnails for the profiles they belong to. Downloads
+    of users without a profile are left alone. Only runs with persistent
+    storage, since otherwise photo_refs doesn't know about earlier runs.
+    Returns the number of files removed.
+    """
+    if not isinstance(storage, SQLiteStorage) or not os.path.isdir(PHOTO_DIR):
+        return 0
+    
+    removed = 0
+    for entry in os.scandir(PHOTO_DIR):
+        if not entry.is_file() or entry.name in photo_refs:
+            continue
+        
+        legacy = LEGACY_PHOTO_NAME.fullmatch(entry.name)
+        if legacy is not None:
+            user_id = int(legacy.group(1))
+            if user_id not in user_data:
+                continue
+            person = user_data[user_id]
+            if person.photo_file is None:
+                try:
+                    person.photo_file = make_thumbnail(entry.path, PHOTO_DIR)
+                except Exception as e:
+                    print(f"Error converting photo {entry.name}: {e}")
+                    continue
+                retain_photo(person.photo_file)
+                user_data[user_id] = person
+        elif not (entry.name.endswith(".part") or THUMBNAIL_NAME.fullmatch(entry.name)):
+            continue
+        remove_file(entry.path)
+        removed += 1
+    return removed
+
+def match_score(person1, person2, games1):
+    """
+    Score two people the same way as calculate_match_score, without
+    building the details. Used for ranking in the findmatch inner loop,
+    where games1 is frozenset(person1.game_ids) built once per query.
+    """
+    score = len(games1.intersection(person2.game_ids)) * 20
+    if person1.station_id != NO_STATION and person2.station_id != NO_STATION:
+        score += STATION_BONUSES[person1.station_id * STATION_COUNT + person2.station_id]
+    return score
+
+def calculate_match_score(person1, person2):
+    """Calculate how well two people match based on games and location"""
+    games2 = set(person2.game_ids)
+    common = {}  # {game_id: person1's spelling}
+    for game_id, game in zip(person1.game_ids, person1.games):
+        if game_id in games2:
+            common.setdefault(game_id, game)
+    common_games = list(common.values())
+    match_score = len(common_games) * 20
+    
+    # Look up MRT distance if both have MRT locations
+    distance_km = None
+    station_id1 = person1.station_id
+    station_id2 = person2.station_id
+    if station_id1 != NO_STATION and station_id2 != NO_STATION:
+        distance_km = station_distance(station_id1, station_id2)
+        
+        # Bonus points for being closer (max 30 points)
+        match_score += station_bonus(station_id1, station_id2)
+    
+    return {
+        'score': match_score,
+        'common_games': common_games,
+        'distance_km': distance_km
+    }
+
+def get_connection_key(user1_id, user2_id):
+    """Generate a consistent connection key"""
+    return tuple(sorted([user1_id, user2_id]))
+
+def get_user_connections(user_id):
+    """Get all connections for a user"""
+    return active_connections.connections_of(user_id)
+
+def get_other_user_id(connection_key, user_id):
+    """Get the other user's ID from a connection key"""
+    return connection_key[0] if connection_key[1] == user_id else connection_key[1]
+
+def normalize_game(game):
+    """Normalize a game name for indexing (case and whitespace insensitive)"""
+    return " ".join(game.split()).casefold()
+
+def index_profile(user_id, name, games, location):
+    """Add a profile's name, games and station to the indexes"""
+    name_index.setdefault(name.casefold(), set()).add(user_id)
+    for game in games:
+        game_index.setdefault(normalize_game(game), set()).add(user_id)
+    
+    station_id = STATION_IDS.get(location)
+    if station_id is not None:
+        station_index.setdefault(station_id, set()).add(user_id)
+
+def unindex_profile(user_id, name, games, location):
+    """Remove a profile's name, games and station from the indexes"""
+    remove_from_index(name_index, name.casefold(), user_id)
+    for game in games:
+        remove_from_index(game_index, normalize_game(game), user_id)
+    remove_from_index(station_index, STATION_IDS.get(location), user_id)
+
+def remove_from_index(index, key, user_id):
+    """Remove user_id from index[key], dropping the key once it's empty"""
+    users = index.get(key)
+    if users is not None:
+        users.discard(user_id)
+        if not users:
+            del index[key]
+
+def index_username(user_id, username):
+    """Index (or re-index) a profiled user's Discord username"""
+    unindex_username(user_id)
+    usernames[user_id] = username
+    username_index.setdefault(username.casefold(), set()).add(user_id)
+
+def unindex_username(user_id):
+    """Drop a user's Discord username from the index"""
+    username = usernames.pop(user_id, None)
+    if username is not None:
+        remove_from_index(username_index, username.casefold(), user_id)
+
+def resolve_message_target(user_id, index, name):
+    """
+    Find the user a !msg/!dm from user_id is meant for. Returns
+    (target_id, matching_ids): target_id is None if nobody matches or the
+    name is ambiguous. When several users share the name, only the ones
+    the sender is connected to are considered.
+    """
+    matching_ids = index.get(name.casefold(), set())
+    if len(matching_ids) > 1:
+        connected_ids = matching_ids & {
+            get_other_user_id(key, user_id) for key in get_user_connections(user_id)
+        }
+        if len(connected_ids) == 1:
+            return next(iter(connected_ids)), matching_ids
+        return None, matching_ids
+    
+    return next(iter(matching_ids), None), matching_ids
+
+def register_profile(user_id, person):
+    """Store a profile (replacing any previous one) and index it"""
+    old_person = user_data.get(user_id)
+    retain_photo(person.photo_file)
+    if old_person is not None:
+        unindex_profile(user_id, old_person.name, old_person.games, old_person.location)
+        release_photo(old_person.photo_file)
+    
+    user_data[user_id] = person
+    index_profile(user_id, person.name, person.games, person.location)
+    if match_engine is not None:
+        match_engine.add(user_id, person.game_ids, person.station_id)
+    
+    if old_person is not None:
+        match_cache.invalidate_around(old_person)
+    match_cache.invalidate_around(person)
+
+def unregister_profile(user_id):
+    """Remove a profile and drop it from the indexes"""
+    person = user_data.pop(user_id, None)
+    if person is not None:
+        unindex_profile(user_id, person.name, person.games, person.location)
+        unindex_username(user_id)
+        release_photo(person.photo_file)
+        if match_engine is not None:
+            match_engine.remove(user_id)
+        match_cache.invalidate_around(person)
+    return person
+
+def delete_profile(user_id):
+    """
+    Remove a profile and all of its connections in one synchronous step, so
+    no other handler sees a half-deleted user and the storage writes land in
+    the same flush. Returns the removed Person and connection keys.
+    """
+    removed_keys = active_connections.remove_user(user_id)
+    person = unregister_profile(user_id)
+    return person, removed_keys
+
+def get_match_candidates(user_id, person):
+    """
+    Get the ids of users who could score above zero against person:
+    anyone sharing a game or living within NEARBY_KM.
+    """
+    candidates = set()
+    for game in person.games:
+        users = game_index.get(normalize_game(game))
+        if users:
+            candidates |= users
+    
+    station_id = person.station_id
+    if station_id != NO_STATION:
+        for neighbour_id in STATION_NEIGHBOURS[station_id]:
+            users = station_index.get(neighbour_id)
+            if users:
+                candidates |= users
+    
+    candidates.discard(user_id)
+    return candidates
+
+class MatchCache:
+    """
+    LRU cache of find_matches results. An entry is only used while the
+    user's own profile and connection version stamps are unchanged;
+    when anyone else's profile is saved or deleted, invalidate_around drops
+    the entries of exactly the users who could have them as a candidate.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # {user_id: (profile stamp, connection stamp, limit, result, games, station_id)}
+        self._generation = 0  # bumped by every invalidate_around
+    
+    def get(self, user_id, limit):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        profile_stamp, connection_stamp, cached_limit, result, _, _ = entry
+        if (cached_limit != limit
+                or profile_stamp != user_data.version(user_id)
+                or connection_stamp != active_connections.version(user_id)):
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return result
+    
+    def token(self, user_id):
+        """Take before computing a result that may await; put() ignores it if anything changed since"""
+        return user_data.version(user_id), active_connections.version(user_id), self._generation
+    
+    def put(self, user_id, limit, person, result, token=None):
+        profile_stamp, connection_stamp, generation = token or self.token(user_id)
+        if generation != self._generation:
+            return
+        self._entries[user_id] = (
+            profile_stamp,
+            connection_stamp,
+            limit,
+            result,
+            frozenset(normalize_game(game) for game in person.games),
+            person.station_id,
+        )
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def invalidate_around(self, person):
+        """Drop cached results of everyone person is (or was) a match candidate for"""
+        games = {normalize_game(game) for game in person.games}
+        nearby = set(STATION_NEIGHBOURS[person.station_id]) if person.station_id != NO_STATION else ()
+        stale = [
+            user_id for user_id, (_, _, _, _, cached_games, station_id) in self._entries.items()
+            if station_id in nearby or not games.isdisjoint(cached_games)
+        ]
+        for user_id in stale:
+            del self._entries[user_id]
+        self._generation += 1
+    
+    def clear(self):
+        self._entries.clear()
+        self._generation += 1
+    
+    def __len__(self):
+        return len(self._entries)
+
+match_cache = MatchCache()
+
+def find_matches(user_id, limit=5):
+    """
+    Find a user's best matches, excluding themselves and existing connections.
+    Returns (number of users scoring above 0, [(other_id, score), ...] best first).
+    Results are memoized in match_cache until something they depend on changes.
+    """
+    result = match_cache.get(user_id, limit)
+    if result is None:
+        result = compute_matches(user_id, limit)
+        match_cache.put(user_id, limit, user_data[user_id], result)
+    return result
+
+async def find_matches_async(user_id, limit=5):
+    """
+    find_matches for command handlers: with the sharded engine the scoring
+    runs in the shard processes while the event loop keeps going, and with
+    the Python scorer the candidates' profiles are read from storage on a
+    worker thread first.
+    """
+    if match_engine is None and match_cache.get(user_id, limit) is None:
+        await user_data.load_many_async([user_id])
+        if user_id in user_data:
+            await user_data.load_many_async(get_match_candidates(user_id, user_data[user_id]))
+    if not isinstance(match_engine, ShardedMatcher):
+        return find_matches(user_id, limit)
+    
+    result = match_cache.get(user_id, limit)
+    if result is None:
+        token = match_cache.token(user_id)
+        person = user_data[user_id]
+        connected_ids = {get_other_user_id(key, user_id) for key in get_user_connections(user_id)}
+        result = await match_engine.find_matches_async(user_id, connected_ids, limit)
+        match_cache.put(user_id, limit, person, result, token)
+    return result
+
+def compute_matches(user_id, limit=5):
+    """find_matches without the cache"""
+    connected_ids = {get_other_user_id(key, user_id) for key in get_user_connections(user_id)}
+    if match_engine is not None:
+        return match_engine.find_matches(user_id, connected_ids, limit)
+    
+    person = user_data[user_id]
+    candidates = get_match_candidates(user_id, person)
+    user_data.load_many(candidates)
+    return select_top_matches(score_candidates(person, candidates, connected_ids), limit)
+
+def score_candidates(person, candidates, exclude_ids):
+    """Yield (other_id, score) for every candidate scoring above 0"""
+    games = frozenset(person.game_ids)
+    for other_id in candidates:
+        if other_id in exclude_ids:
+            continue
+        
+        score = match_score(person, user_data[other_id], games)
+        if score > 0:
+            yield other_id, score
+
+def select_top_matches(scored, limit):
+    """
+    Keep the best limit (other_id, score) pairs from an iterable using a
+    bounded heap instead of sorting everything. Equal scores go to the
+    lower user id so results are stable.
+    Returns (number of pairs seen, [(other_id, score), ...] best first).
+    """
+    heap = []  # min-heap of (score, -other_id), worst kept match on top
+    count = 0
+    for other_id, score in scored:
+        count += 1
+        entry = (score, -other_id)
+        if len(heap) < limit:
+            heappush(heap, entry)
+        elif entry > heap[0]:
+            heapreplace(heap, entry)
+    
+    heap.sort(reverse=True)
+    return count, [(-negative_id, score) for score, negative_id in heap]
+
+class NumpyMatcher:
+    """
+    Column store of every profile's station id, with games kept as a
+    sparse matrix stored by column: for each game id, an array of the rows
+    that play it. Scoring one user against everyone is one bonus lookup
+    plus a bincount over the rows of the user's games. Follows the same
+    rules as calculate_match_score.
+    """
+    def __init__(self, capacity=1024):
+        self._rows = {}  # {user_id: row}
+        self._games = {}  # {user_id: (game_id, ...) without duplicates}
+        self._game_rows = {}  # {game_id: [rows array, rows in use]}
+        self._size = 0
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.station_ids = np.full(capacity, NO_STATION, dtype=np.int16)
+        
+        # Extra zero row/column so NO_STATION (-1) indexes to a bonus of 0
+        self._bonuses = np.zeros((STATION_COUNT + 1, STATION_COUNT + 1), dtype=np.int32)
+        self._bonuses[:STATION_COUNT, :STATION_COUNT] = np.frombuffer(
+            STATION_BONUSES, dtype=np.uint8
+        ).reshape(STATION_COUNT, STATION_COUNT)
+    
+    def __len__(self):
+        return self._size
+    
+    def _grow(self, rows):
+        """Make room for at least rows rows"""
+        capacity = len(self.user_ids)
+        if rows > capacity:
+            new_capacity = max(rows, capacity * 2)
+            self.user_ids = np.resize(self.user_ids, new_capacity)
+            self.station_ids = np.resize(self.station_ids, new_capacity)
+    
+    def _add_game_row(self, game_id, row):
+        column = self._game_rows.get(game_id)
+        if column is None:
+            column = self._game_rows[game_id] = [np.empty(4, dtype=np.int32), 0]
+        rows, used = column
+        if used == len(rows):
+            rows = column[0] = np.resize(rows, used * 2)
+        rows[used] = row
+        column[1] = used + 1
+    
+    def _remove_game_row(self, game_id, row):
+        column = self._game_rows[game_id]
+        rows, used = column
+        used -= 1
+        if not used:
+            del self._game_rows[game_id]
+            return
+        rows[np.flatnonzero(rows[:used + 1] == row)[0]] = rows[used]
+        column[1] = used
+    
+    def _move_game_row(self, game_id, old_row, new_row):
+        rows, used = self._game_rows[game_id]
+        rows[np.flatnonzero(rows[:used] == old_row)[0]] = new_row
+    
+    def add(self, user_id, game_ids, station_id):
+        """Add or replace a profile's row"""
+        row = self._rows.get(user_id)
+        if row is None:
+            row = self._size
+            self._grow(row + 1)
+            self._rows[user_id] = row
+            self._size += 1
+        else:
+            for game_id in self._games[user_id]:
+                self._remove_game_row(game_id, row)
+        
+        game_ids = self._games[user_id] = tuple(dict.fromkeys(game_ids))
+        for game_id in game_ids:
+            self._add_game_row(game_id, row)
+        self.user_ids[row] = user_id
+        self.station_ids[row] = station_id
+    
+    load = add
+    
+    def remove(self, user_id):
+        """Remove a profile's row by moving the last row into its place"""
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            return
+        for game_id in self._games.pop(user_id):
+            self._remove_game_row(game_id, row)
+        
+        last = self._size - 1
+        if row != last:
+            moved_id = int(self.user_ids[last])
+            self.user_ids[row] = moved_id
+            self.station_ids[row] = self.station_ids[last]
+            for game_id in self._games[moved_id]:
+                self._move_game_row(game_id, last, row)
+            self._rows[moved_id] = row
+        self._size = last
+    
+    def scores(self, user_id, exclude_ids=()):
+        """Score user_id against every row; the user and exclude_ids score 0"""
+        size = self._size
+        row = self._rows[user_id]
+        
+        scores = self._bonuses[self.station_ids[row], self.station_ids[:size]]
+        columns = [rows[:used] for rows, used in map(self._game_rows.__getitem__, self._games[user_id])]
+        if columns:
+            shared = np.bincount(np.concatenate(columns), minlength=size)
+            scores += (shared * 20).astype(np.int32)
+        
+        scores[row] = 0
+        for other_id in exclude_ids:
+            other_row = self._rows.get(other_id)
+            if other_row is not None:
+                scores[other_row] = 0
+        return scores
+    
+    def find_matches(self, user_id, exclude_ids=(), limit=5):
+        """Same contract as find_matches, using argpartition for the top-k"""
+        scores = self.scores(user_id, exclude_ids)
+        positive = np.flatnonzero(scores > 0)
+        top = positive
+        if positive.size > limit:
+            # Keep everything tied with the k-th best score so ties can be
+            # broken by user id, like select_top_matches does
+            positive_scores = scores[positive]
+            kth_score = positive_scores[np.argpartition(-positive_scores, limit - 1)[:limit]].min()
+            top = positive[positive_scores >= kth_score]
+        top = top[np.lexsort((self.user_ids[top], -scores[top]))[:limit]]
+        return int(positive.size), [(int(self.user_ids[row]), int(scores[row])) for row in top]
+
+class ProfileIndex:
+    """
+    Profiles as (game ids, station id) tuples, indexed by game id and
+    station so the users scoring above 0 against someone (sharing a game
+    or a station within NEARBY_KM) can be found without a full scan.
+    Scores follow the match_score rules.
+    """
+    def __init__(self):
+        self._profiles = {}  # {user_id: (sorted unique game_ids, station_id)}
+        self._game_users = {}  # {game_id: {user_id, ...}}
+        self._station_users = {}  # {station_id: {user_id, ...}}
+    
+    def __len__(self):
+        return len(self._profiles)
+    
+    def _score(self, profile1, games1, profile2):
+        """Score two profiles; games1 is frozenset(profile1[0]), built once per query"""
+        score = len(games1.intersection(profile2[0])) * 20
+        if profile1[1] != NO_STATION and profile2[1] != NO_STATION:
+            score += STATION_BONUSES[profile1[1] * STATION_COUNT + profile2[1]]
+        return score
+    
+    def _candidates(self, user_id, profile):
+        candidates = set()
+        for game_id in profile[0]:
+            users = self._game_users.get(game_id)
+            if users:
+                candidates |= users
+        if profile[1] != NO_STATION:
+            for neighbour_id in STATION_NEIGHBOURS[profile[1]]:
+                users = self._station_users.get(neighbour_id)
+                if users:
+                    candidates |= users
+        candidates.discard(user_id)
+        return candidates
+    
+    def _index(self, user_id, game_ids, station_id):
+        game_ids = tuple(sorted(set(game_ids)))
+        for game_id in game_ids:
+            self._game_users.setdefault(game_id, set()).add(user_id)
+        if station_id != NO_STATION:
+            self._station_users.setdefault(station_id, set()).add(user_id)
+        profile = self._profiles[user_id] = (game_ids, station_id)
+        return profile
+    
+    def _unindex(self, user_id):
+        profile = self._profiles.pop(user_id)
+        for game_id in profile[0]:
+            users = self._game_users[game_id]
+            users.discard(user_id)
+            if not users:
+                del self._game_users[game_id]
+        if profile[1] != NO_STATION:
+            users = self._station_users[profile[1]]
+            users.discard(user_id)
+            if not users:
+                del self._station_users[profile[1]]
+        return profile
+
+class IncrementalMatcher(ProfileIndex):
+    """
+    Keeps every user's best matches precomputed. Adding or removing a
+    profile only touches the users it shares a game or a nearby station
+    with (exactly the users it scores above 0 against), updating their
+    match count and stored top list with the match_score rules, so
+    find_matches is a read. A user whose stored list loses an entry it
+    can't refill is dropped and recomputed the next time it's read.
+    """
+    def __init__(self, keep=10):
+        super().__init__()
+        self.keep = keep  # stored matches per user; extra ones cover excluded connections
+        self._state = {}  # {user_id: [match count, [(-score, other_id), ...] best first]}
+    
+    def load(self, user_id, game_ids, station_id):
+        """Add a profile without updating anyone's matches, for the initial fill"""
+        if self._state:
+            self.add(user_id, game_ids, station_id)
+            return
+        if user_id in self._profiles:
+            self._unindex(user_id)
+        self._index(user_id, game_ids, station_id)
+    
+    def add(self, user_id, game_ids, station_id):
+        """Add or replace a profile, pushing it into its candidates' top lists"""
+        if user_id in self._profiles:
+            self.remove(user_id)
+        profile = self._index(user_id, game_ids, station_id)
+        games = frozenset(profile[0])
+        
+        matches = []
+        for other_id in self._candidates(user_id, profile):
+            score = self._score(profile, games, self._profiles[other_id])
+            matches.append((-score, other_id))
+            
+            state = self._state.get(other_id)
+            if state is None:
+                continue
+            state[0] += 1
+            top = state[1]
+            entry = (-score, user_id)
+            if len(top) < self.keep:
+                if state[0] == len(top) + 1:
+                    insort(top, entry)
+                # otherwise other_id's list is already missing entries and gets recomputed
+            elif entry < top[-1]:
+                insort(top, entry)
+                top.pop()
+        
+        self._state[user_id] = [len(matches), nsmallest(self.keep, matches)]
+    
+    def remove(self, user_id):
+        """Remove a profile and take it out of its candidates' top lists"""
+        if user_id not in self._profiles:
+            return
+        profile = self._unindex(user_id)
+        games = frozenset(profile[0])
+        self._state.pop(user_id, None)
+        
+        for other_id in self._candidates(user_id, profile):
+            state = self._state.get(other_id)
+            if state is None:
+                continue
+            state[0] -= 1
+            top = state[1]
+            entry = (-self._score(profile, games, self._profiles[other_id]), user_id)
+            position = bisect_left(top, entry)
+            if position < len(top) and top[position] == entry:
+                del top[position]
+                if state[0] > len(top):
+                    # The next best match isn't stored; recompute when next read
+                    del self._state[other_id]
+    
+    def _rebuild(self, user_id):
+        profile = self._profiles[user_id]
+        games = frozenset(profile[0])
+        matches = [
+            (-self._score(profile, games, self._profiles[other_id]), other_id)
+            for other_id in self._candidates(user_id, profile)
+        ]
+        state = self._state[user_id] = [len(matches), nsmallest(self.keep, matches)]
+        return state
+    
+    def find_matches(self, user_id, exclude_ids=(), limit=5):
+        """Same contract as find_matches"""
+        state = self._state.get(user_id) or self._rebuild(user_id)
+        match_count, top = state
+        profile = self._profiles[user_id]
+        games = frozenset(profile[0])
+        
+        excluded = 0
+        for other_id in exclude_ids:
+            other = self._profiles.get(other_id)
+            if other is not None and other_id != user_id and self._score(profile, games, other) > 0:
+                excluded += 1
+        
+        best = [(other_id, -negative_score) for negative_score, other_id in top if other_id not in exclude_ids]
+        if len(best) < limit and match_count > len(top):
+            # Exclusions ate into the stored list; score this one from scratch
+            scored = (
+                (other_id, self._score(profile, games, self._profiles[other_id]))
+                for other_id in self._candidates(user_id, profile)
+                if other_id not in exclude_ids
+            )
+            return select_top_matches(scored, limit)
+        return match_count - excluded, best[:limit]
+    
+    def check_user(self, user_id):
+        """Recompute one user's stored matches; returns False if they were wrong"""
+        state = self._state.get(user_id)
+        if state is None or user_id not in self._profiles:
+            return True
+        return self._rebuild(user_id) == state
+    
+    async def run_consistency_checks(self, interval=3600.0, budget=0.005):
+        """
+        Every interval seconds recompute everyone's stored matches, yielding
+        to the event loop once a turn has used budget seconds (so after
+        every user whose check alone takes longer).
+        """
+        while True:
+            await asyncio.sleep(interval)
+            mismatches = 0
+            turn_started = time.perf_counter()
+            for user_id in list(self._state):
+                if not self.check_user(user_id):
+                    mismatches += 1
+                if time.perf_counter() - turn_started >= budget:
+                    await asyncio.sleep(0)
+                    turn_started = time.perf_counter()
+            if mismatches:
+                print(f"Incremental matcher: fixed {mismatches} out-of-date match lists")
+
+def pack_profiles(rows):
+    """Pack (user_id, game_ids, station_id) rows into one flat block of arrays"""
+    user_ids = array('q')
+    station_ids = array('h')
+    offsets = array('I', [0])
+    game_ids = array('I')
+    for user_id, games, station_id in rows:
+        user_ids.append(user_id)
+        station_ids.append(station_id)
+        game_ids.extend(games)
+        offsets.append(len(game_ids))
+    header = array('Q', [len(user_ids), len(game_ids)])
+    return b"".join(part.tobytes() for part in (header, user_ids, station_ids, offsets, game_ids))
+
+def unpack_arrays(data):
+    """Inverse of pack_profiles; returns its (user_ids, station_ids, offsets, game_ids) arrays"""
+    header = array('Q')
+    header.frombytes(data[:header.itemsize * 2])
+    user_count, game_count = header
+    position = header.itemsize * 2
+    parts = []
+    for typecode, length in (('q', user_count), ('h', user_count), ('I', user_count + 1), ('I', game_count)):
+        part = array(typecode)
+        end = position + part.itemsize * length
+        part.frombytes(data[position:end])
+        parts.append(part)
+        position = end
+    return tuple(parts)
+
+def build_postings(keys, rows, key_count):
+    """
+    Group rows by key from two parallel arrays, like a sparse matrix stored
+    by column: key's rows are postings[starts[key]:starts[key + 1]].
+    Returns (starts, postings).
+    """
+    starts = array('I', [0]) * (key_count + 1)
+    for key in keys:
+        starts[key + 1] += 1
+    for key in range(key_count):
+        starts[key + 1] += starts[key]
+    
+    postings = array('I', [0]) * len(rows)
+    positions = array('I', starts)
+    for key, row in zip(keys, rows):
+        postings[positions[key]] = row
+        positions[key] += 1
+    return starts, postings
+
+class MatchShard:
+    """
+    The profiles one ShardedMatcher worker process scores against, kept in
+    the pack_profiles layout: flat arrays of user ids and station ids, and
+    each row's sorted unique game ids back to back, plus postings arrays of
+    the rows playing each game and living at each station. Rows are sorted
+    by user id and found by bisection. Added profiles are appended as tail
+    rows, scanned on every query, and replaced or removed ones are marked
+    dead; once those make up a quarter of the rows the arrays are repacked.
+    Scores follow the match_score rules.
+    """
+    def __init__(self):
+        self._adopt(array('q'), array('h'), array('I', [0]), array('I'))
+    
+    def __len__(self):
+        return len(self._user_ids) - self._dead_count
+    
+    def _adopt(self, user_ids, station_ids, offsets, game_ids):
+        """Take packed arrays, sorted by user id, as the shard's rows and index them"""
+        self._user_ids = user_ids
+        self._station_ids = station_ids
+        self._offsets = offsets
+        self._game_ids = game_ids
+        self._sorted = len(user_ids)  # rows before this one are sorted and in the postings
+        self._tail = {}  # {user_id: row} for live rows appended since
+        self._dead = bytearray(len(user_ids))
+        self._dead_count = 0
+        
+        game_rows = array('I')
+        for row in range(len(user_ids)):
+            game_rows.extend(array('I', [row]) * (offsets[row + 1] - offsets[row]))
+        self._game_starts, self._game_postings = build_postings(
+            game_ids, game_rows, max(game_ids, default=-1) + 1
+        )
+        station_rows = array('I', (row for row, station_id in enumerate(station_ids) if station_id != NO_STATION))
+        self._station_starts, self._station_postings = build_postings(
+            array('h', map(station_ids.__getitem__, station_rows)), station_rows, STATION_COUNT
+        )
+    
+    def _row(self, user_id):
+        """The live row of a user, or None"""
+        row = self._tail.get(user_id)
+        if row is None:
+            row = bisect_left(self._user_ids, user_id, 0, self._sorted)
+            if row == self._sorted or self._user_ids[row] != user_id or self._dead[row]:
+                return None
+        return row
+    
+    def load(self, user_ids, station_ids, offsets, game_ids):
+        """Add the rows of unpack_arrays' arrays, sorted by user id with sorted unique games"""
+        if not len(self):
+            self._adopt(user_ids, station_ids, offsets, game_ids)
+            return
+        for i, user_id in enumerate(user_ids):
+            self.add(user_id, game_ids[offsets[i]:offsets[i + 1]], station_ids[i])
+    
+    def add(self, user_id, game_ids, station_id):
+        """Add or replace a profile as a tail row"""
+        self.remove(user_id)
+        self._tail[user_id] = len(self._user_ids)
+        self._user_ids.append(user_id)
+        self._station_ids.append(station_id)
+        self._game_ids.extend(sorted(set(game_ids)))
+        self._offsets.append(len(self._game_ids))
+        self._dead.append(0)
+        self._repack_if_needed()
+    
+    def remove(self, user_id):
+        row = self._row(user_id)
+        if row is None:
+            return
+        self._tail.pop(user_id, None)
+        self._dead[row] = 1
+        self._dead_count += 1
+        self._repack_if_needed()
+    
+    def _repack_if_needed(self):
+        if len(self._user_ids) - self._sorted + self._dead_count > max(64, len(self._user_ids) // 4):
+            self._repack()
+    
+    def _repack(self):
+        """Rewrite the live rows sorted by user id and rebuild the postings"""
+        user_ids = array('q')
+        station_ids = array('h')
+        offsets = array('I', [0])
+        game_ids = array('I')
+        live = (row for row in range(len(self._user_ids)) if not self._dead[row])
+        for row in sorted(live, key=self._user_ids.__getitem__):
+            user_ids.append(self._user_ids[row])
+            station_ids.append(self._station_ids[row])
+            game_ids.extend(self._game_ids[self._offsets[row]:self._offsets[row + 1]])
+            offsets.append(len(game_ids))
+        self._adopt(user_ids, station_ids, offsets, game_ids)
+    
+    def top_matches(self, user_id, game_ids, station_id, exclude_ids, limit):
+        """This shard's (match count, top matches) for a profile, like find_matches"""
+        games = frozenset(game_ids)
+        shared = {}  # {row: games in common}, for every row that might score above 0
+        starts, postings = self._game_starts, self._game_postings
+        for game_id in games:
+            if game_id < len(starts) - 1:
+                for row in postings[starts[game_id]:starts[game_id + 1]]:
+                    shared[row] = shared.get(row, 0) + 1
+        if station_id != NO_STATION:
+            starts, postings = self._station_starts, self._station_postings
+            for neighbour_id in STATION_NEIGHBOURS[station_id]:
+                for row in postings[starts[neighbour_id]:starts[neighbour_id + 1]]:
+                    shared.setdefault(row, 0)
+        # Tail rows aren't in the postings
+        for row in self._tail.values():
+            shared[row] = len(games.intersection(self._game_ids[self._offsets[row]:self._offsets[row + 1]]))
+        
+        def scored():
+            for row, common in shared.items():
+                other_id = self._user_ids[row]
+                if self._dead[row] or other_id == user_id or other_id in exclude_ids:
+                    continue
+                score = common * 20
+                other_station_id = self._station_ids[row]
+                if station_id != NO_STATION and other_station_id != NO_STATION:
+                    score += STATION_BONUSES[station_id * STATION_COUNT + other_station_id]
+                if score > 0:
+                    yield other_id, score
+        
+        return select_top_matches(scored(), limit)
+
+# The shard held by a ShardedMatcher worker process (unused in the bot's own process)
+match_shard = None
+
+def get_match_shard():
+    global match_shard
+    if match_shard is None:
+        match_shard = MatchShard()
+    return match_shard
+
+def shard_load(shared_memory_name, size):
+    """Worker: add every profile in a pack_profiles snapshot from shared memory"""
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        data = bytes(block.buf[:size])
+    finally:
+        block.close()
+    shard = get_match_shard()
+    shard.load(*unpack_arrays(data))
+    return len(shard)
+
+def shard_add(user_id, game_ids, station_id):
+    get_match_shard().add(user_id, game_ids, station_id)
+
+def shard_remove(user_id):
+    get_match_shard().remove(user_id)
+
+def shard_top_matches(user_id, game_ids, station_id, exclude_ids, limit):
+    return get_match_shard().top_matches(user_id, game_ids, station_id, exclude_ids, limit)
+
+def merge_top_matches(results, limit):
+    """Combine per-shard (count, top matches) with select_top_matches' ordering"""
+    matches = sorted(
+        (match for _, top in results for match in top),
+        key=lambda match: (-match[1], match[0])
+    )
+    return sum(count for count, _ in results), matches[:limit]
+
+def report_shard_error(future):
+    """Print why a shard call failed; returns True if it did"""
+    if future.cancelled() or future.exception() is None:
+        return False
+    print(f"Error updating match shard: {future.exception()!r}")
+    return True
+
+class ShardedMatcher:
+    """
+    Scores in worker processes so big scans never block the event loop.
+    Profiles are split across shards by user id, each shard a process of
+    its own (a single-worker pool, so its updates and queries run in the
+    order they were sent). The initial profiles reach each shard as one
+    packed snapshot in shared memory, whose arrays the worker keeps as its
+    MatchShard; later changes are sent one add or remove at a time. A
+    query goes to every shard, each returns its local top matches, and
+    the results are merged. If a shard call fails, that shard's worker is
+    replaced and sent a fresh snapshot from user_data on the next call.
+    """
+    def __init__(self, shards=None):
+        self.shards = shards or os.cpu_count() or 1
+        self._executors = [ProcessPoolExecutor(max_workers=1) for _ in range(self.shards)]
+        self._loading = [[] for _ in range(self.shards)]
+        self._user_ids = set()
+        self._failed = set()  # shards to rebuild; filled from executor callback threads
+    
+    def __len__(self):
+        return len(self._user_ids)
+    
+    def load(self, user_id, game_ids, station_id):
+        """Queue a profile for the initial snapshot"""
+        self._loading[user_id % self.shards].append((user_id, tuple(sorted(set(game_ids))), station_id))
+        self._user_ids.add(user_id)
+    
+    def _submit(self, shard, function, *args):
+        """Send an update to a shard, marking the shard for a rebuild if it fails"""
+        def done(future):
+            if report_shard_error(future):
+                self._failed.add(shard)
+        
+        try:
+            future = self._executors[shard].submit(function, *args)
+        except BrokenProcessPool:
+            self._failed.add(shard)
+            return None
+        future.add_done_callback(done)
+        return future
+    
+    def _rebuild_failed(self):
+        """Replace the worker of every failed shard and queue a full snapshot for it"""
+        while self._failed:
+            shard = self._failed.pop()
+            print(f"Rebuilding match shard {shard}")
+            # Work already queued on the old worker still runs; nothing new goes to it
+            self._executors[shard].shutdown(wait=False)
+            self._executors[shard] = ProcessPoolExecutor(max_workers=1)
+            rows = self._loading[shard] = []
+            for user_id in self._user_ids:
+                if user_id % self.shards == shard:
+                    person = user_data.get(user_id)
+                    if person is not None:
+                        rows.append((user_id, tuple(sorted(set(person.game_ids))), person.station_id))
+    
+    def _publish(self):
+        """Send queued profiles to their shards through shared memory"""
+        self._rebuild_failed()
+        for shard, rows in enumerate(self._loading):
+            if not rows:
+                continue
+            # MatchShard keeps the snapshot's rows as they are, sorted by user id
+            rows.sort()
+            data = pack_profiles(rows)
+            rows.clear()
+            block = shared_memory.SharedMemory(create=True, size=len(data))
+            block.buf[:len(data)] = data
+            future = self._submit(shard, shard_load, block.name, len(data))
+            if future is None:
+                block.close()
+                block.unlink()
+            else:
+                future.add_done_callback(lambda _, block=block: (block.close(), block.unlink()))
+    
+    def add(self, user_id, game_ids, station_id):
+        """Add or replace a profile on its shard"""
+        self._publish()
+        self._user_ids.add(user_id)
+        self._submit(user_id % self.shards, shard_add, user_id, tuple(game_ids), station_id)
+    
+    def remove(self, user_id):
+        self._publish()
+        self._user_ids.discard(user_id)
+        self._submit(user_id % self.shards, shard_remove, user_id)
+    
+    def _query(self, user_id, exclude_ids, limit):
+        """Send a query to every shard, returning their futures; a shard whose worker died is rebuilt"""
+        self._publish()
+        person = user_data[user_id]
+        args = (user_id, person.game_ids, person.station_id, frozenset(exclude_ids), limit)
+        
+        def done(future, shard):
+            if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                self._failed.add(shard)
+        
+        futures = []
+        for shard, executor in enumerate(self._executors):
+            try:
+                future = executor.submit(shard_top_matches, *args)
+            except BrokenProcessPool:
+                self._failed.add(shard)
+                raise
+            future.add_done_callback(lambda future, shard=shard: done(future, shard))
+            futures.append(future)
+        return futures
+    
+    def find_matches(self, user_id, exclude_ids=(), limit=5):
+        """Same contract as find_matches; blocks until every shard has answered"""
+        futures = self._query(user_id, exclude_ids, limit)
+        return merge_top_matches([future.result() for future in futures], limit)
+    
+    async def find_matches_async(self, user_id, exclude_ids=(), limit=5):
+        """find_matches that awaits the shards instead of blocking the event loop"""
+        futures = self._query(user_id, exclude_ids, limit)
+        results = await asyncio.gather(*map(asyncio.wrap_future, futures))
+        return merge_top_matches(results, limit)
+    
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_match_engine():
+    if isinstance(match_engine, ShardedMatcher):
+        match_engine.close()
+
+def configure_matcher(name):
+    """Select the matching engine: 'python' (default), 'numpy', 'incremental' or 'sharded'"""
+    global match_engine
+    shutdown_match_engine()
+    match_engine = None
+    if name == 'numpy':
+        if np is None:
+            print("NumPy is not installed, using the Python matcher")
+            return
+        match_engine = NumpyMatcher()
+    elif name == 'incremental':
+        match_engine = IncrementalMatcher()
+    elif name == 'sharded':
+        match_engine = ShardedMatcher()
+    else:
+        return
+    
+    for user_id, person in user_data.items():
+        match_engine.load(user_id, person.game_ids, person.station_id)
+
+class TrialScheduler:
+    """
+    Fires trial deadlines from a min-heap in a single asyncio task instead
+    of one sleeping task per connection. Scheduling is O(log n); cancelling
+    just marks the heap entry as removed so it is skipped when it comes up.
+    """
+    REMOVED = None  # Placeholder key for cancelled entries
+    
+    def __init__(self, callback):
+        self.callback = callback  # async callback(connection_key, kind)
+        self._heap = []  # [[due_at, sequence, connection_key, kind], ...]
+        self._entries = {}  # {connection_key: {kind: heap entry}}
+        self._sequence = count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+    
+    def __len__(self):
+        return sum(len(kinds) for kinds in self._entries.values())
+    
+    def schedule(self, connection_key, kind, due_at):
+        """Call callback(connection_key, kind) at due_at, replacing any earlier schedule"""
+        self.cancel(connection_key, kind)
+        entry = [due_at, next(self._sequence), connection_key, kind]
+        self._entries.setdefault(connection_key, {})[kind] = entry
+        heappush(self._heap, entry)
+        # Wake the runner in case this is now the earliest deadline
+        self._wakeup.set()
+    
+    def cancel(self, connection_key, kind=None):
+        """Cancel one kind of deadline for a connection, or all of them"""
+        kinds = self._entries.get(connection_key)
+        if not kinds:
+            return
+        
+        for entry_kind in [kind] if kind else list(kinds):
+            entry = kinds.pop(entry_kind, None)
+            if entry is not None:
+                entry[2] = self.REMOVED
+        if not kinds:
+            del self._entries[connection_key]
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            while self._heap and self._heap[0][2] is self.REMOVED:
+                heappop(self._heap)
+            
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            _, _, connection_key, kind = heappop(self._heap)
+            self.cancel(connection_key, kind)
+            try:
+                await self.callback(connection_key, kind)
+            except Exception as e:
+                print(f"Error handling trial {kind} for {connection_key}: {e}")
+
+class LatencyStats:
+    """Call count, latency histogram and per-phase time totals for one command"""
+    __slots__ = ('calls', 'sampled', 'total', 'buckets', 'phases')
+    
+    def __init__(self, bucket_count):
+        self.calls = 0
+        self.sampled = 0
+        self.total = 0.0
+        self.buckets = [0] * (bucket_count + 1)  # last bucket is +Inf
+        self.phases = {}
+
+NULL_BLOCK = nullcontext()  # what timed() and phase() return when metrics are off
+
+class MetricsSample:
+    __slots__ = ('name', 'started', 'phases', 'token')
+
+class Metrics:
+    """
+    Lightweight timing for command handlers. Every call is counted;
+    sample_rate of them are also timed into a latency histogram, with the
+    time spent in phase() blocks ('scoring', 'rest', 'send') broken out
+    per command. A sample_rate of 0 leaves just the counting.
+    """
+    PHASES = ('scoring', 'rest', 'send')
+    # 0.1 ms to ~74 s, two buckets per doubling
+    LATENCY_BUCKETS = tuple(0.0001 * 2 ** (i / 2) for i in range(40))
+    
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.stats = {}  # {command name: LatencyStats}
+        self._current = contextvars.ContextVar('metrics_sample', default=None)
+    
+    @property
+    def enabled(self):
+        """Whether any calls are timed"""
+        return self.sample_rate > 0
+    
+    def count(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = LatencyStats(len(self.LATENCY_BUCKETS))
+        stats.calls += 1
+    
+    def start(self, name):
+        """Count a call to name and start timing it if it is sampled; returns the sample or None"""
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = LatencyStats(len(self.LATENCY_BUCKETS))
+        stats.calls += 1
+        if not self.sample_rate or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        
+        sample = MetricsSample()
+        sample.name = name
+        sample.phases = {}
+        sample.token = self._current.set(sample)
+        sample.started = time.perf_counter()
+        return sample
+    
+    def finish(self, sample):
+        if sample is None:
+            return
+        elapsed = time.perf_counter() - sample.started
+        try:
+            self._current.reset(sample.token)
+        except ValueError:
+            # Finished from a different context than it started in
+            self._current.set(None)
+        
+        stats = self.stats[sample.name]
+        stats.sampled += 1
+        stats.total += elapsed
+        stats.buckets[bisect_left(self.LATENCY_BUCKETS, elapsed)] += 1
+        for phase, seconds in sample.phases.items():
+            stats.phases[phase] = stats.phases.get(phase, 0.0) + seconds
+    
+    def timed(self, name):
+        """Context manager that times a block as one call to name"""
+        if not self.sample_rate:
+            self.count(name)
+            return NULL_BLOCK
+        return _TimedBlock(self, name)
+    
+    def phase(self, phase):
+        """Context manager that adds a block's time to phase of the sample being timed"""
+        if not self.sample_rate:
+            return NULL_BLOCK
+        return _PhaseBlock(self._current.get(), phase)
+    
+    def percentile(self, stats, fraction):
+        """Upper bound of the histogram bucket holding the given fraction of samples, in seconds"""
+        if not stats.sampled:
+            return None
+        rank = fraction * stats.sampled
+        seen = 0
+        for bound, bucket in zip(self.LATENCY_BUCKETS, stats.buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return float('inf')
+    
+    def snapshot(self, gauges):
+        """Everything recorded so far as a JSON-friendly dict"""
+        commands = {}
+        for name, stats in sorted(self.stats.items()):
+            commands[name] = {
+                'calls': stats.calls,
+                'sampled': stats.sampled,
+                'mean_seconds': stats.total / stats.sampled if stats.sampled else None,
+                'p50_seconds': self.percentile(stats, 0.50),
+                'p95_seconds': self.percentile(stats, 0.95),
+                'p99_seconds': self.percentile(stats, 0.99),
+                'phase_seconds': dict(stats.phases),
+            }
+        return {'sample_rate': self.sample_rate, 'commands': commands, 'gauges': dict(gauges)}
+    
+    def to_prometheus(self, gauges):
+        """Everything recorded so far in the Prometheus text format"""
+        stats_by_name = sorted(self.stats.items())
+        lines = ["# TYPE gametalk_command_calls_total counter"]
+        for name, stats in stats_by_name:
+            lines.append(f'gametalk_command_calls_total{{command="{name}"}} {stats.calls}')
+        
+        lines.append("# TYPE gametalk_command_latency_seconds histogram")
+        for name, stats in stats_by_name:
+            label = f'command="{name}"'
+            cumulative = 0
+            for bound, bucket in zip(self.LATENCY_BUCKETS, stats.buckets):
+                cumulative += bucket
+                lines.append(f'gametalk_command_latency_seconds_bucket{{{label},le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'gametalk_command_latency_seconds_bucket{{{label},le="+Inf"}} {stats.sampled}')
+            lines.append(f"gametalk_command_latency_seconds_sum{{{label}}} {stats.total}")
+            lines.append(f"gametalk_command_latency_seconds_count{{{label}}} {stats.sampled}")
+        
+        lines.append("# TYPE gametalk_command_phase_seconds_total counter")
+        for name, stats in stats_by_name:
+            for phase, seconds in sorted(stats.phases.items()):
+                lines.append(f'gametalk_command_phase_seconds_total{{command="{name}",phase="{phase}"}} {seconds}')
+        
+        for name, value in gauges.items():
+            lines.append(f"# TYPE gametalk_{name} gauge")
+            lines.append(f"gametalk_{name} {value}")
+        return "\n".join(lines) + "\n"
+    
+    def write(self, path, gauges):
+        """Write a JSON (for .json paths) or Prometheus text dump, replacing the file atomically"""
+        if path.endswith('.json'):
+            content = json.dumps(self.snapshot(gauges), indent=2) + "\n"
+        else:
+            content = self.to_prometheus(gauges)
+        
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+    
+    async def run_dumper(self, path, gauges, interval=60.0):
+        """Write a dump to path every interval seconds; gauges() gives the current store sizes"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.write, path, gauges())
+            except OSError as e:
+                print(f"Error writing metrics: {e}")
+
+class _TimedBlock:
+    __slots__ = ('metrics', 'name', 'sample')
+    
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+    
+    def __enter__(self):
+        self.sample = self.metrics.start(self.name)
+    
+    def __exit__(self, *exc_info):
+        self.metrics.finish(self.sample)
+
+class _PhaseBlock:
+    __slots__ = ('sample', 'phase', 'started')
+    
+    def __init__(self, sample, phase):
+        self.sample = sample
+        self.phase = phase
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+    
+    def __exit__(self, *exc_info):
+        if self.sample is not None:
+            phases = self.sample.phases
+            phases[self.phase] = phases.get(self.phase, 0.0) + time.perf_counter() - self.started
+
+metrics = Metrics()
+
+def store_gauges():
+    """Current sizes of the in-memory stores"""
+    return {
+        'profiles': len(user_data),
+        'connections': len(active_connections),
+    }
+
+class RelayFull(Exception):
+    """Raised when the message relay queue is full"""
+
+def rate_limit_delay(error):
+    """Seconds to wait before retrying if error is a rate limit, otherwise None"""
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after
+    if isinstance(error, discord.HTTPException) and error.status == 429:
+        try:
+            return float(error.response.headers.get('Retry-After', 1))
+        except (AttributeError, TypeError, ValueError):
+            return 1.0
+    return None
+
+class MessageRelay:
+    """
+    Delivers relayed chat messages outside the command handlers. At most
+    max_queue messages may be waiting (queued or pending a send) at once;
+    past that submit() raises RelayFull. A dispatcher hands them to one worker per
+    recipient, which waits coalesce_window seconds for more messages to
+    the same person and sends them all as one Discord message. Rate
+    limits are retried after their retry-after with exponential backoff.
+    submit() returns a future that resolves when the message is delivered.
+    """
+    MAX_MESSAGE_LENGTH = 2000  # Discord's limit
+    SEPARATOR = "\n\n"
+    
+    def __init__(self, send, max_queue=1000, coalesce_window=0.5, max_retries=5):
+        self.send = send  # async send(recipient_id, content)
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self._waiting = 0  # messages submitted but not yet delivered or failed
+        self._queue = asyncio.Queue()
+        self._pending = {}  # {recipient_id: deque of (content, future)}
+        self._workers = {}  # {recipient_id: worker task}
+        self._dispatcher = None
+        self.stats = {'delivered': 0, 'failed': 0, 'sends': 0, 'retries': 0}
+    
+    def start(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+    
+    def submit(self, recipient_id, content):
+        """Queue a message, returning a future for its delivery. Raises RelayFull."""
+        if self._waiting >= self.max_queue:
+            raise RelayFull("Too many messages are waiting to be delivered")
+        delivery = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((recipient_id, content, delivery))
+        self._waiting += 1
+        return delivery
+    
+    async def _dispatch(self):
+        while True:
+            recipient_id, content, delivery = await self._queue.get()
+            self._pending.setdefault(recipient_id, deque()).append((content, delivery))
+            if recipient_id not in self._workers:
+                self._workers[recipient_id] = asyncio.create_task(self._work(recipient_id))
+    
+    async def _work(self, recipient_id):
+        try:
+            while True:
+                await asyncio.sleep(self.coalesce_window)
+                pending = self._pending.get(recipient_id)
+                if not pending:
+                    break
+                await self._deliver(recipient_id, self._take_batch(pending))
+        finally:
+            del self._workers[recipient_id]
+            if not self._pending.get(recipient_id):
+                self._pending.pop(recipient_id, None)
+    
+    def _take_batch(self, pending):
+        """Take as many queued messages as fit in one Discord message"""
+        batch = [pending.popleft()]
+        length = len(batch[0][0])
+        while pending and length + len(self.SEPARATOR) + len(pending[0][0]) <= self.MAX_MESSAGE_LENGTH:
+            content, delivery = pending.popleft()
+            batch.append((content, delivery))
+            length += len(self.SEPARATOR) + len(content)
+        return batch
+    
+    async def _deliver(self, recipient_id, batch):
+        content = self.SEPARATOR.join(content for content, _ in batch)
+        backoff = 1.0
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.stats['sends'] += 1
+                await self.send(recipient_id, content)
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is not None and attempt < self.max_retries:
+                    self.stats['retries'] += 1
+                    await asyncio.sleep(max(delay, backoff))
+                    backoff *= 2
+                    continue
+                self._finish(batch, error=e)
+                return
+            self._finish(batch)
+            return
+    
+    def _finish(self, batch, error=None):
+        self._waiting -= len(batch)
+        for _, delivery in batch:
+            if delivery.done():
+                continue
+            if error is None:
+                delivery.set_result(True)
+            else:
+                delivery.set_exception(error)
+        self.stats['failed' if error else 'delivered'] += len(batch)
+
+class UserCache:
+    """
+    Resolve Discord users by id without a REST call where possible: the
+    bot's user and member caches are checked first, then a TTL + LRU cache
+    of previously fetched users. Concurrent lookups of the same id share a
+    single fetch_user request.
+    """
+    def __init__(self, bot, ttl=600, max_size=2048):
+        self.bot = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users = OrderedDict()  # {user_id: (user, expires_at)}
+        self._in_flight = {}  # {user_id: fetch task}
+    
+    def get_cached(self, user_id):
+        """Get a user from any cache, or None"""
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            return user
+        
+        for guild in self.bot.guilds:
+            member = guild.get_member(user_id)
+            if member is not None:
+                return member
+        
+        entry = self._users.get(user_id)
+        if entry is not None:
+            user, expires_at = entry
+            if expires_at > time.monotonic():
+                self._users.move_to_end(user_id)
+                return user
+            del self._users[user_id]
+        return None
+    
+    async def get(self, user_id):
+        """Get a user, fetching it from Discord if no cache has it"""
+        user = self.get_cached(user_id)
+        if user is not None:
+            return user
+        
+        task = self._in_flight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_id))
+            self._in_flight[user_id] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(user_id, None))
+        # Shield so one cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+    
+    async def get_many(self, user_ids, concurrency=5):
+        """
+        Resolve several users concurrently, at most concurrency fetches at a
+        time. Results are in the same order as user_ids; a failed lookup
+        gives back its exception instead of a user.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def resolve(user_id):
+            async with semaphore:
+                return await self.get(user_id)
+        
+        return await asyncio.gather(*(resolve(user_id) for user_id in user_ids), return_exceptions=True)
+    
+    async def _fetch(self, user_id):
+        with metrics.phase('rest'):
+            user = await self.bot.fetch_user(user_id)
+        self._users[user_id] = (user, time.monotonic() + self.ttl)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+        return user
 
-def calculate_match_score(person1, person2):
-    """Calculate how well two people match based on games and location"""
-    common_games = list(set(person1.games) & set(person2.games))
-    match_score = len(common_games) * 20
+class DMChannelCache:
+    """
+    LRU cache of DM channels by user id, so sending to someone we've
+    messaged before is a single API call instead of a user lookup plus a
+    create_dm. Concurrent lookups of the same user share one request.
+    """
+    def __init__(self, user_cache, max_size=4096):
+        self.user_cache = user_cache
+        self.max_size = max_size
+        self._channels = OrderedDict()  # {user_id: DMChannel}
+        self._in_flight = {}  # {user_id: open task}
     
-    # Calculate MRT distance if both have MRT locations
-    distance_km = None
-    if person1.location in MRT_COORDINATES and person2.location in MRT_COORDINATES:
-        distance_km = get_mrt_distance(person1.location, person2.location)
-        
-        # Bonus points for being closer (max 30 points)
-        if distance_km is not None:
-            if distance_km < 2:
-                match_score += 30
-            elif distance_km < 5:
-                match_score += 20
-            elif distance_km < 10:
-                match_score += 10
+    async def get(self, user_id):
+        """Get the DM channel with a user, opening it if needed"""
+        channel = self._channels.get(user_id)
+        if channel is not None:
+            self._channels.move_to_end(user_id)
+            return channel
+        
+        task = self._in_flight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._open(user_id))
+            self._in_flight[user_id] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(user_id, None))
+        return await asyncio.shield(task)
     
-    return {
-        'score': match_score,
-        'common_games': common_games,
-        'distance_km': distance_km
-    }
+    async def send(self, user_id, *args, **kwargs):
+        """Send a DM to a user"""
+        channel = await self.get(user_id)
+        try:
+            with metrics.phase('send'):
+                return await channel.send(*args, **kwargs)
+        except discord.NotFound:
+            # Stale channel; open a fresh one next time
+            self.discard(user_id)
+            raise
+    
+    def discard(self, user_id):
+        self._channels.pop(user_id, None)
+    
+    async def _open(self, user_id):
+        user = await self.user_cache.get(user_id)
+        with metrics.phase('rest'):
+            channel = user.dm_channel or await user.create_dm()
+        self._channels[user_id] = channel
+        self._channels.move_to_end(user_id)
+        while len(self._channels) > self.max_size:
+            self._channels.popitem(last=False)
+        return channel
 
-def get_connection_key(user1_id, user2_id):
-    """Generate a consistent connection key"""
-    return tuple(sorted([user1_id, user2_id]))
+class CommandRateLimited(commands.CheckFailure):
+    """Raised by the global rate limit check; retry_after is in seconds"""
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
 
-def get_user_connections(user_id):
-    """Get all connections for a user"""
-    return [key for key in active_connections.keys() if user_id in key]
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+    
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
 
-def get_other_user_id(connection_key, user_id):
-    """Get the other user's ID from a connection key"""
-    return connection_key[0] if connection_key[1] == user_id else connection_key[1]
+class RateLimiter:
+    """
+    Token buckets keyed by (user id, command class). Every bucket refills
+    at rate tokens per second up to capacity, and each command costs
+    COMMAND_COSTS tokens. Buckets are kept in least recently used order
+    and dropped once idle long enough to have refilled, which is the same
+    as starting a new one, so memory only grows with recently active users.
+    """
+    # Commands sharing a class share a bucket; anything else is 'general'
+    COMMAND_CLASSES = {
+        'setup': 'profile', 'profile': 'profile', 'update': 'profile', 'delete': 'profile',
+        'findmatch': 'matching', 'connect': 'matching', 'makedecision': 'matching',
+        'viewteam': 'team', 'myteam': 'team', 'removemember': 'team',
+        'msg': 'messaging', 'dm': 'messaging', 'relay': 'messaging',
+    }
+    # Scans and multi-user fetches cost more; anything else costs 1
+    COMMAND_COSTS = {'findmatch': 5, 'delete': 5, 'viewteam': 3, 'myteam': 3, 'setup': 2, 'connect': 2}
+    
+    def __init__(self, rate=0.5, capacity=10.0, max_buckets=100_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_buckets = max_buckets
+        self.idle_seconds = capacity / rate
+        self._buckets = OrderedDict()  # {(user_id, command class): TokenBucket}, least recently used first
+    
+    def acquire(self, user_id, command):
+        """Charge user_id for command; returns 0 if allowed, otherwise seconds until it would be"""
+        now = time.monotonic()
+        self._evict_idle(now)
+        
+        key = (user_id, self.COMMAND_CLASSES.get(command, 'general'))
+        cost = self.COMMAND_COSTS.get(command, 1)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        
+        if bucket.tokens < cost:
+            return (cost - bucket.tokens) / self.rate
+        bucket.tokens -= cost
+        return 0
+    
+    def _evict_idle(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket.updated < self.idle_seconds:
+                break
+            del buckets[key]
+    
+    def __len__(self):
+        return len(self._buckets)
 
-def main():
-    load_dotenv()
+# At most this many !findmatch runs (scoring plus Discord lookups) at once
+SCORING_CONCURRENCY = 4
+
+class GameTalkBot(commands.Bot):
+    async def on_command_error(self, ctx, error):
+        if isinstance(error, CommandRateLimited):
+            await ctx.send(f"⏳ Slow down! Try again in {ceil(error.retry_after)}s.")
+        elif isinstance(error, commands.MaxConcurrencyReached):
+            await ctx.send("⏳ Lots of people are finding matches right now. Try again in a few seconds!")
+        else:
+            await super().on_command_error(ctx, error)
+    
+    async def close(self):
+        await close_http_session()
+        shutdown_photo_pool()
+        shutdown_match_engine()
+        await super().close()
+
+def create_bot(storage):
+    """
+    Build the bot and register its events and commands. storage must
+    already be loaded with load_storage. Nothing connects to Discord until
+    the bot is run, so the command handlers can also be driven directly.
+    """
+    flusher_task = None
+    metrics_task = None
+    consistency_task = None
     
     intents = discord.Intents.default()
     intents.message_content = True
     intents.members = True
     
-    bot = commands.Bot(command_prefix='!', intents=intents)
+    bot = GameTalkBot(command_prefix='!', intents=intents)
+    user_cache = UserCache(bot)
+    dm_channels = DMChannelCache(user_cache)
+    
+    # Undecided trials are released this long after the trial period ends
+    trial_grace = timedelta(minutes=float(os.getenv('GAMETALK_TRIAL_GRACE_MINUTES', '1440')))
+    
+    # Metrics are dumped here every minute if set (JSON for .json paths, Prometheus text otherwise)
+    metrics_file = os.getenv('GAMETALK_METRICS_FILE')
+    
+    rate_limiter = RateLimiter()
+    
+    @bot.check
+    async def within_rate_limit(ctx):
+        # !help runs every command's checks to filter its list; only charge for the invoked command
+        if ctx.command is not bot.get_command(ctx.invoked_with or ''):
+            return True
+        retry_after = rate_limiter.acquire(ctx.author.id, ctx.command.qualified_name)
+        if retry_after:
+            raise CommandRateLimited(retry_after)
+        return True
+    
+    # Count every command and time the sampled ones. With SQLite storage the
+    # profiles of the author and any users passed as arguments are loaded
+    # on a worker thread first, so the handler finds them in memory.
+    prefetch_profiles = isinstance(storage, SQLiteStorage)
+    
+    @bot.before_invoke
+    async def start_command_timer(ctx):
+        ctx.metrics_sample = metrics.start(ctx.command.qualified_name)
+        if prefetch_profiles:
+            user_ids = [ctx.author.id]
+            user_ids.extend(
+                argument.id for argument in (*ctx.args, *ctx.kwargs.values())
+                if isinstance(argument, (discord.User, discord.Member))
+            )
+            await user_data.load_many_async(user_ids)
+    
+    @bot.after_invoke
+    async def finish_command_timer(ctx):
+        metrics.finish(getattr(ctx, 'metrics_sample', None))
+    
+    # asyncio only keeps weak references to tasks, so fire-and-forget work
+    # is held here until it finishes
+    background_tasks = set()
+    
+    def run_in_background(coroutine):
+        task = asyncio.create_task(coroutine)
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        return task
+    
+    async def notify(user_id, content):
+        """DM a user, ignoring failures"""
+        try:
+            await dm_channels.send(user_id, content)
+        except Exception:
+            pass
+    
+    async def notify_many(user_ids, content, concurrency=5):
+        """DM several users concurrently, at most concurrency sends at a time"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def send(user_id):
+            async with semaphore:
+                await notify(user_id, content)
+        
+        await asyncio.gather(*(send(user_id) for user_id in user_ids))
+    
+    async def on_trial_due(connection_key, kind):
+        """Handle a trial reaching 30 minutes or running out of grace time"""
+        connection = active_connections.get(connection_key)
+        if connection is None or connection.get('permanent', False):
+            return
+        
+        user1_id, user2_id = connection_key
+        user1_name = user_data[user1_id].name if user1_id in user_data else "your teammate"
+        user2_name = user_data[user2_id].name if user2_id in user_data else "your teammate"
+        
+        if kind == 'trial_over':
+            for user_id, other_name in ((user1_id, user2_name), (user2_id, user1_name)):
+                await notify(
+                    user_id,
+                    f"⏰ Your 30-minute trial with {other_name} is over! "
+                    f"Use `!makedecision @user keep` or `!makedecision @user release` to decide."
+                )
+        else:
+            del active_connections[connection_key]
+            for user_id, other_name in ((user1_id, user2_name), (user2_id, user1_name)):
+                await notify(user_id, f"👋 Your trial with {other_name} was released because no decision was made in time.")
+    
+    trial_scheduler = TrialScheduler(on_trial_due)
+    
+    relay = MessageRelay(dm_channels.send)
+    
+    async def report_delivery(message, delivery):
+        """React to the sender's message once it's delivered, or report the failure"""
+        try:
+            await delivery
+        except Exception as e:
+            await message.channel.send(f"❌ Failed to send message: {str(e)}")
+            return
+        try:
+            await message.add_reaction("✅")
+        except discord.HTTPException:
+            pass
+    
+    async def relay_message(message, recipient_id, content):
+        """Queue a relayed chat message, reporting delivery on the sender's message"""
+        try:
+            delivery = relay.submit(recipient_id, content)
+        except RelayFull:
+            await message.channel.send("❌ Too many messages are waiting to be delivered, try again in a moment.")
+            return
+        run_in_background(report_delivery(message, delivery))
+    
+    def schedule_trial(connection_key, connection):
+        """Schedule the end-of-trial reminder and the auto-release for a connection"""
+        trial_end = connection['timestamp'] + TRIAL_PERIOD
+        if trial_end > datetime.now():
+            trial_scheduler.schedule(connection_key, 'trial_over', trial_end)
+        trial_scheduler.schedule(connection_key, 'release', trial_end + trial_grace)
     
     @bot.event
     async def on_ready():
+        nonlocal flusher_task, metrics_task, consistency_task
         print(f'{bot.user} has connected to Discord!')
         print(f'Bot is in {len(bot.guilds)} server(s)')
+        
+        # Index usernames of profiled users the gateway has cached
+        for user_id in user_data:
+            user = bot.get_user(user_id)
+            if user is not None:
+                index_username(user_id, user.name)
+        
+        # Pick up trials loaded from storage; rescheduling one just replaces it
+        for connection_key, connection in active_connections.items():
+            if not connection.get('permanent', False):
+                schedule_trial(connection_key, connection)
+        trial_scheduler.start()
+        relay.start()
+        
+        # on_ready fires again after reconnects, so only start the flusher once
+        if flusher_task is None and isinstance(storage, SQLiteStorage):
+            flusher_task = asyncio.create_task(storage.run_flusher())
+        if metrics_task is None and metrics_file:
+            metrics_task = asyncio.create_task(metrics.run_dumper(metrics_file, store_gauges))
+        if consistency_task is None and isinstance(match_engine, IncrementalMatcher):
+            consistency_task = asyncio.create_task(match_engine.run_consistency_checks())
+
+    @bot.event
+    async def on_user_update(before, after):
+        """Keep the username index current when a profiled user renames"""
+        if after.id in user_data and before.name != after.name:
+            index_username(after.id, after.name)
+
+    @bot.event
+    async def on_member_update(before, after):
+        """Pick up username changes seen through member updates"""
+        if after.id in user_data and usernames.get(after.id) != after.name:
+            index_username(after.id, after.name)
 
     @bot.command()
     async def setup(ctx):
@@ -508,22 +3201,24 @@ def main():
             )
             
             photo_url = None
+            photo_file = None
             photo_response = await bot.wait_for('message', check=check, timeout=60.0)
             
             if photo_response.content.lower() != 'skip':
                 if photo_response.attachments:
                     photo_url = photo_response.attachments[0].url
-                    await download_photo(photo_url, user_id)
+                    photo_file = await store_photo(photo_url, user_id)
                 elif ctx.author.avatar:
                     photo_url = ctx.author.avatar.url
-                    await download_photo(photo_url, user_id)
+                    photo_file = await store_photo(photo_url, user_id)
             elif ctx.author.avatar:
                 photo_url = ctx.author.avatar.url
-                await download_photo(photo_url, user_id)
+                photo_file = await store_photo(photo_url, user_id)
             
             # Create person object
-            person = Person(name, age, games, location, bio, photo_url)
-            user_data[user_id] = person
+            person = Person(name, age, games, location, bio, photo_url, photo_file)
+            register_profile(user_id, person)
+            index_username(user_id, ctx.author.name)
             
             # Create confirmation embed
             embed = discord.Embed(
@@ -537,12 +3232,10 @@ def main():
             embed.add_field(name="📍 Nearest MRT", value=location, inline=True)
             embed.add_field(name="Bio", value=bio, inline=False)
             
-            if photo_url:
-                embed.set_thumbnail(url=photo_url)
-            
             embed.set_footer(text="Use !findmatch to find gaming buddies!")
             
-            await ctx.send(embed=embed)
+            with metrics.phase('send'):
+                await send_profile_embed(ctx, embed, person)
             
         except asyncio.TimeoutError:
             await ctx.send("❌ Setup timed out. Please try again with `!setup`")
@@ -572,17 +3265,15 @@ def main():
         embed.add_field(name="📍 Nearest MRT", value=person.location, inline=True)
         embed.add_field(name="Bio", value=person.bio, inline=False)
         
-        if person.photo_url:
-            embed.set_thumbnail(url=person.photo_url)
-        
         # Show connections count
-        connections = get_user_connections(user_id)
-        permanent_count = sum(1 for key in connections if active_connections[key].get('permanent', False))
+        permanent_count = active_connections.permanent_count(user_id)
         embed.set_footer(text=f"Permanent Teammates: {permanent_count}/{MAX_CONNECTIONS}")
         
-        await ctx.send(embed=embed)
+        with metrics.phase('send'):
+            await send_profile_embed(ctx, embed, person)
 
     @bot.command()
+    @commands.max_concurrency(SCORING_CONCURRENCY, wait=False)
     async def findmatch(ctx):
         """Find best gaming matches"""
         user_id = ctx.author.id
@@ -592,71 +3283,74 @@ def main():
             return
         
         current_person = user_data[user_id]
-        user_connections = get_user_connections(user_id)
-        permanent_connections = [key for key in user_connections if active_connections[key].get('permanent', False)]
         
-        if len(permanent_connections) >= MAX_CONNECTIONS:
+        if active_connections.permanent_count(user_id) >= MAX_CONNECTIONS:
             await ctx.send(f"❌ You've reached the maximum of {MAX_CONNECTIONS} permanent teammates!\nUse `!removemember @user` to make space.")
             return
         
         # Find potential matches (excluding self and existing connections)
-        matches = []
-        for other_id, other_person in user_data.items():
-            if other_id == user_id:
-                continue
-            
-            connection_key = get_connection_key(user_id, other_id)
-            if connection_key in active_connections:
-                continue
+        with metrics.phase('scoring'):
+            match_count, best_matches = await find_matches_async(user_id, limit=5)
             
-            match_data = calculate_match_score(current_person, other_person)
-            if match_data['score'] > 0:
-                matches.append((other_id, match_data))
+            # Only build match details for the ones shown (skipping anyone deleted meanwhile)
+            top_matches = [
+                (other_id, calculate_match_score(current_person, user_data[other_id]))
+                for other_id, _ in best_matches
+                if other_id in user_data
+            ]
+        
+        members = await user_cache.get_many([other_id for other_id, _ in top_matches])
         
-        if not matches:
+        # Profiles can be deleted while the Discord users are fetched
+        shown = [
+            (user_data.get(other_id), match_data, member)
+            for (other_id, match_data), member in zip(top_matches, members)
+        ]
+        shown = [entry for entry in shown if entry[0] is not None]
+        
+        if not shown:
             await ctx.send("😔 No matches found! Try updating your profile or check back later.")
             return
         
-        # Sort by match score
-        matches.sort(key=lambda x: x[1]['score'], reverse=True)
-        top_matches = matches[:5]
-        
         embed = discord.Embed(
             title="🎯 Your Top Gaming Matches",
-            description=f"Found {len(matches)} potential teammates!",
+            description=f"Found {match_count} potential teammates!",
             color=discord.Color.gold()
         )
         
-        for other_id, match_data in top_matches:
-            other_person = user_data[other_id]
-            
-            try:
-                member = await bot.fetch_user(other_id)
-                
-                # Build match field value with distance
-                field_value = (
-                    f"@{member.name}\n"
-                    f"Match Score: {match_data['score']}%\n"
-                    f"🎮 Common Games: {', '.join(match_data['common_games'])}\n"
-                    f"📍 {other_person.location}"
-                )
-                
-                # Add distance if available
-                if match_data['distance_km'] is not None:
-                    field_value += f" ({match_data['distance_km']} km away)"
-                
-                field_value += f"\n📝 {other_person.bio[:80]}..." if len(other_person.bio) > 80 else f"\n📝 {other_person.bio}"
-                
+        for other_person, match_data, member in shown:
+            if isinstance(member, Exception):
                 embed.add_field(
                     name=f"⭐ {other_person.name}",
-                    value=field_value,
+                    value=f"⚠️ Couldn't load Discord user: {member}",
                     inline=False
                 )
-            except:
-                pass
+                continue
+            
+            # Build match field value with distance
+            field_value = (
+                f"@{member.name}\n"
+                f"Match Score: {match_data['score']}%\n"
+                f"🎮 Common Games: {', '.join(match_data['common_games'])}\n"
+                f"📍 {other_person.location}"
+            )
+            
+            # Add distance if available
+            if match_data['distance_km'] is not None:
+                field_value += f" ({match_data['distance_km']} km away)"
+            
+            field_value += f"\n📝 {other_person.bio[:80]}..." if len(other_person.bio) > 80 else f"\n📝 {other_person.bio}"
+            
+            embed.add_field(
+                name=f"⭐ {other_person.name}",
+                value=field_value,
+                inline=False
+            )
         
         embed.set_footer(text="Use !connect @user to team up with a match!")
-        await ctx.send(embed=embed)
+        # Show the best match's photo
+        with metrics.phase('send'):
+            await send_profile_embed(ctx, embed, shown[0][0])
 
     @bot.command()
     async def connect(ctx, member: discord.Member):
@@ -672,17 +3366,11 @@ def main():
             await ctx.send("❌ You can't connect with yourself!")
             return
         
-        user_connections = get_user_connections(user_id)
-        other_connections = get_user_connections(other_id)
-        
-        permanent_user = [key for key in user_connections if active_connections[key].get('permanent', False)]
-        permanent_other = [key for key in other_connections if active_connections[key].get('permanent', False)]
-        
-        if len(permanent_user) >= MAX_CONNECTIONS:
+        if active_connections.permanent_count(user_id) >= MAX_CONNECTIONS:
             await ctx.send(f"❌ You've reached the maximum of {MAX_CONNECTIONS} permanent teammates!")
             return
         
-        if len(permanent_other) >= MAX_CONNECTIONS:
+        if active_connections.permanent_count(other_id) >= MAX_CONNECTIONS:
             await ctx.send(f"❌ {member.display_name} has reached their maximum teammates!")
             return
         
@@ -699,6 +3387,7 @@ def main():
             'user2_decision': None,
             'permanent': False
         }
+        schedule_trial(connection_key, active_connections[connection_key])
         
         # Calculate match info including distance
         match_data = calculate_match_score(user_data[user_id], user_data[other_id])
@@ -730,15 +3419,8 @@ def main():
         await ctx.send(embed=embed)
         
         # Send DMs to both users
-        try:
-            await ctx.author.send(f"✅ You're now connected with {user_data[other_id].name}! Send messages using `!msg {user_data[other_id].name} <message>`")
-        except:
-            pass
-        
-        try:
-            await member.send(f"✅ You're now connected with {user_data[user_id].name}! Send messages using `!msg {user_data[user_id].name} <message>`")
-        except:
-            pass
+        await notify(user_id, f"✅ You're now connected with {user_data[other_id].name}! Send messages using `!msg {user_data[other_id].name} <message>`")
+        await notify(other_id, f"✅ You're now connected with {user_data[user_id].name}! Send messages using `!msg {user_data[user_id].name} <message>`")
 
     @bot.command()
     async def makedecision(ctx, member: discord.Member, decision: str):
@@ -764,8 +3446,8 @@ def main():
         
         # Check if 30 minutes have passed
         time_elapsed = datetime.now() - connection['timestamp']
-        if time_elapsed < timedelta(minutes=30):
-            remaining = timedelta(minutes=30) - time_elapsed
+        if time_elapsed < TRIAL_PERIOD:
+            remaining = TRIAL_PERIOD - time_elapsed
             minutes_left = int(remaining.total_seconds() / 60)
             await ctx.send(f"⏰ Trial period not over yet! {minutes_left} minutes remaining.")
             return
@@ -775,39 +3457,29 @@ def main():
             await ctx.send("❌ Decision must be either `keep` or `release`")
             return
         
-        # Determine which user is making the decision
-        if user_id == connection_key[0]:
-            connection['user1_decision'] = decision
-        else:
-            connection['user2_decision'] = decision
+        # Record the decision for whichever user is making it
+        active_connections.record_decision(connection_key, user_id, decision)
         
         # Check if both users have decided
         if connection['user1_decision'] and connection['user2_decision']:
             if connection['user1_decision'] == 'keep' and connection['user2_decision'] == 'keep':
-                connection['permanent'] = True
+                active_connections.set_permanent(connection_key)
+                trial_scheduler.cancel(connection_key)
                 await ctx.send(f"⭐ **Connection is now permanent!** You and {member.display_name} are now permanent teammates!")
                 
                 # Notify the other user
-                try:
-                    await member.send(f"⭐ Your connection with {user_data[user_id].name} is now permanent!")
-                except:
-                    pass
+                await notify(member.id, f"⭐ Your connection with {user_data[user_id].name} is now permanent!")
             else:
                 # Remove connection
                 del active_connections[connection_key]
+                trial_scheduler.cancel(connection_key)
                 await ctx.send(f"👋 Connection with {member.display_name} has been released.")
                 
-                try:
-                    await member.send(f"👋 Your connection with {user_data[user_id].name} has been released.")
-                except:
-                    pass
+                await notify(member.id, f"👋 Your connection with {user_data[user_id].name} has been released.")
         else:
             await ctx.send(f"✅ Your decision has been recorded. Waiting for {member.display_name}'s decision...")
             
-            try:
-                await member.send(f"⏰ {user_data[user_id].name} has made their decision. Use `!makedecision @{ctx.author.name} keep/release` to decide!")
-            except:
-                pass
+            await notify(member.id, f"⏰ {user_data[user_id].name} has made their decision. Use `!makedecision @{ctx.author.name} keep/release` to decide!")
 
     @bot.command()
     async def send(ctx):
@@ -840,10 +3512,7 @@ def main():
         
         await ctx.send(f"✅ Removed {member.display_name} from your team.")
         
-        try:
-            await member.send(f"👋 {user_data[user_id].name} has removed you from their team.")
-        except:
-            pass
+        await notify(member.id, f"👋 {user_data[user_id].name} has removed you from their team.")
 
     @bot.command()
     async def msg(ctx, *, args: str):
@@ -882,11 +3551,14 @@ def main():
             return
         
         # Find user by profile name
-        target_id = None
-        for uid, person in user_data.items():
-            if person.name.lower() == target_name.lower():
-                target_id = uid
-                break
+        target_id, matching_ids = resolve_message_target(user_id, name_index, target_name)
+        
+        if len(matching_ids) > 1 and target_id is None:
+            await ctx.send(
+                f"❌ {len(matching_ids)} users are named '{target_name}'. "
+                f"Use `!dm Username <message>` to pick one."
+            )
+            return
         
         if target_id is None:
             await ctx.send(f"❌ No user found with name '{target_name}'")
@@ -898,15 +3570,9 @@ def main():
             await ctx.send(f"❌ You're not connected with {target_name}!")
             return
         
-        # Send message
-        try:
-            target_user = await bot.fetch_user(target_id)
-            sender_name = user_data[user_id].name
-            
-            await target_user.send(f"💬 **Message from {sender_name}:**\n{message}")
-            await ctx.send(f"✅ Message sent to {target_name}!")
-        except Exception as e:
-            await ctx.send(f"❌ Failed to send message: {str(e)}")
+        # Queue message; the command message gets a ✅ once it's delivered
+        sender_name = user_data[user_id].name
+        await relay_message(ctx.message, target_id, f"💬 **Message from {sender_name}:**\n{message}")
 
     @bot.command()
     async def dm(ctx, *, args: str):
@@ -945,16 +3611,12 @@ def main():
             return
         
         # Find user by Discord username
-        target_id = None
-        for guild in bot.guilds:
-            for member in guild.members:
-                if member.name.lower() == target_username.lower():
-                    if member.id in user_data:
-                        target_id = member.id
-                        break
-            if target_id:
-                break
-#hi there
+        target_id, matching_ids = resolve_message_target(user_id, username_index, target_username)
+        
+        if len(matching_ids) > 1 and target_id is None:
+            await ctx.send(f"❌ More than one user has the username '{target_username}'.")
+            return
+        
         if target_id is None:
             await ctx.send(f"❌ No connected user found with username '{target_username}'")
             return
@@ -965,15 +3627,9 @@ def main():
             await ctx.send(f"❌ You're not connected with @{target_username}!")
             return
         
-        # Send message
-        try:
-            target_user = await bot.fetch_user(target_id)
-            sender_name = user_data[user_id].name
-            
-            await target_user.send(f"💬 **Message from {sender_name}:**\n{message}")
-            await ctx.send(f"✅ Message sent to @{target_username}!")
-        except Exception as e:
-            await ctx.send(f"❌ Failed to send message: {str(e)}")
+        # Queue message; the command message gets a ✅ once it's delivered
+        sender_name = user_data[user_id].name
+        await relay_message(ctx.message, target_id, f"💬 **Message from {sender_name}:**\n{message}")
 
     @bot.event
     async def on_message(message):
@@ -987,44 +3643,44 @@ def main():
         
         # Check if it's a DM
         if isinstance(message.channel, discord.DMChannel):
-            user_id = message.author.id
-            
-            if user_id not in user_data:
-                return
-            
-            # Find all connections
-            user_connections = get_user_connections(user_id)
-            
-            if len(user_connections) == 0:
-                await message.channel.send("❌ You're not connected with anyone! Use `!findmatch` to find teammates.")
-                return
-            
-            if len(user_connections) == 1:
-                # Auto-send to the only connection
-                connection_key = user_connections[0]
-                other_id = get_other_user_id(connection_key, user_id)
+            with metrics.timed('on_message'):
+                user_id = message.author.id
                 
-                try:
-                    other_user = await bot.fetch_user(other_id)
-                    sender_name = user_data[user_id].name
+                if user_id not in user_data:
+                    return
+                
+                # Find all connections
+                user_connections = get_user_connections(user_id)
+                
+                if len(user_connections) == 0:
+                    await message.channel.send("❌ You're not connected with anyone! Use `!findmatch` to find teammates.")
+                    return
+                
+                if len(user_connections) == 1:
+                    retry_after = rate_limiter.acquire(user_id, 'relay')
+                    if retry_after:
+                        await message.channel.send(f"⏳ Slow down! Try again in {ceil(retry_after)}s.")
+                        return
                     
-                    await other_user.send(f"💬 **Message from {sender_name}:**\n{message.content}")
-                    await message.channel.send(f"✅ Message sent to {user_data[other_id].name}!")
-                except Exception as e:
-                    await message.channel.send(f"❌ Failed to send message: {str(e)}")
-            else:
-                # Multiple connections - ask user to specify
-                names = []
-                for key in user_connections:
-                    other_id = get_other_user_id(key, user_id)
-                    if other_id in user_data:
-                        names.append(user_data[other_id].name)
+                    # Auto-send to the only connection
+                    connection_key = user_connections[0]
+                    other_id = get_other_user_id(connection_key, user_id)
                 
-                await message.channel.send(
-                    f"You have multiple connections! Please use:\n"
-                    f"`!msg <name> <message>` to specify who to message.\n\n"
-                    f"Your connections: {', '.join(names)}"
-                )
+                    sender_name = user_data[user_id].name
+                    await relay_message(message, other_id, f"💬 **Message from {sender_name}:**\n{message.content}")
+                else:
+                    # Multiple connections - ask user to specify
+                    names = []
+                    for key in user_connections:
+                        other_id = get_other_user_id(key, user_id)
+                        if other_id in user_data:
+                            names.append(user_data[other_id].name)
+                
+                    await message.channel.send(
+                        f"You have multiple connections! Please use:\n"
+                        f"`!msg <name> <message>` to specify who to message.\n\n"
+                        f"Your connections: {', '.join(names)}"
+                    )
 
     @bot.command()
     async def update(ctx):
@@ -1046,21 +3702,18 @@ def main():
             await ctx.send("❌ You don't have a profile!")
             return
         
-        # Remove all connections
-        connections_to_remove = get_user_connections(user_id)
-        for key in connections_to_remove:
-            other_id = get_other_user_id(key, user_id)
-            del active_connections[key]
-            
-            # Notify the other user
-            try:
-                other_user = await bot.fetch_user(other_id)
-                await other_user.send(f"👋 {user_data[user_id].name} has deleted their profile. Your connection has been removed.")
-            except:
-                pass
+        # Remove the profile and all connections at once
+        person, removed_keys = delete_profile(user_id)
+        for key in removed_keys:
+            trial_scheduler.cancel(key)
         
-        del user_data[user_id]
         await ctx.send("✅ Your profile has been deleted along with all connections.")
+        
+        # Notify former teammates in the background
+        run_in_background(notify_many(
+            [get_other_user_id(key, user_id) for key in removed_keys],
+            f"👋 {person.name} has deleted their profile. Your connection has been removed."
+        ))
 
     @bot.command()
     async def viewteam(ctx, member: discord.Member = None):
@@ -1085,35 +3738,44 @@ def main():
                 color=discord.Color.blue()
             )
             
-            for connection_key in user_connections:
-                other_id = get_other_user_id(connection_key, user_id)
-                
-                if other_id not in user_data:
+            teammate_ids = [
+                other_id for other_id in (get_other_user_id(key, user_id) for key in user_connections)
+                if other_id in user_data
+            ]
+            other_users = await user_cache.get_many(teammate_ids)
+            
+            # Profiles and connections can go away while the Discord users are fetched
+            current_person = user_data.get(user_id)
+            for other_id, other_user in zip(teammate_ids, other_users):
+                other_person = user_data.get(other_id)
+                connection = active_connections.get(get_connection_key(user_id, other_id))
+                if current_person is None or other_person is None or connection is None:
                     continue
                 
-                other_person = user_data[other_id]
+                is_permanent = connection.get('permanent', False)
+                status = "⭐ Permanent" if is_permanent else "⏰ Trial"
                 
-                try:
-                    other_user = await bot.fetch_user(other_id)
-                    
-                    is_permanent = active_connections[connection_key].get('permanent', False)
-                    status = "⭐ Permanent" if is_permanent else "⏰ Trial"
-                    
-                    # Calculate distance
-                    match_data = calculate_match_score(user_data[user_id], other_person)
-                    distance_text = f" ({match_data['distance_km']} km away)" if match_data['distance_km'] else ""
-                    
-                    # Smart formatting for names with spaces
-                    msg_cmd = f'!msg "{other_person.name}"' if ' ' in other_person.name else f'!msg {other_person.name}'
-                    dm_cmd = f'!dm "{other_user.name}"' if ' ' in other_user.name else f'!dm {other_user.name}'
-                    
+                if isinstance(other_user, Exception):
                     embed.add_field(
                         name=f"{status} - {other_person.name}",
-                        value=f"{other_user.mention} (`{other_user.name}`)\n📍 {other_person.location}{distance_text}\n💬 `{msg_cmd} <message>`\n📧 `{dm_cmd} <message>`",
+                        value=f"⚠️ Couldn't load Discord user: {other_user}",
                         inline=False
                     )
-                except:
-                    pass
+                    continue
+                
+                # Look up distance
+                distance_km = get_mrt_distance(current_person.location, other_person.location)
+                distance_text = f" ({distance_km} km away)" if distance_km else ""
+                
+                # Smart formatting for names with spaces
+                msg_cmd = f'!msg "{other_person.name}"' if ' ' in other_person.name else f'!msg {other_person.name}'
+                dm_cmd = f'!dm "{other_user.name}"' if ' ' in other_user.name else f'!dm {other_user.name}'
+                
+                embed.add_field(
+                    name=f"{status} - {other_person.name}",
+                    value=f"{other_user.mention} (`{other_user.name}`)\n📍 {other_person.location}{distance_text}\n💬 `{msg_cmd} <message>`\n📧 `{dm_cmd} <message>`",
+                    inline=False
+                )
             
             embed.set_footer(text="Use !chat @user to get specific DM info")
             await ctx.send(embed=embed)
@@ -1129,9 +3791,9 @@ def main():
         other_person = user_data[member.id]
         is_permanent = active_connections[connection_key].get('permanent', False)
         
-        # Calculate distance
-        match_data = calculate_match_score(user_data[user_id], other_person)
-        distance_text = f"{match_data['distance_km']} km away" if match_data['distance_km'] else "Distance unavailable"
+        # Look up distance
+        distance_km = get_mrt_distance(user_data[user_id].location, other_person.location)
+        distance_text = f"{distance_km} km away" if distance_km else "Distance unavailable"
         
         # Smart formatting for names with spaces
         msg_cmd = f'!msg "{other_person.name}"' if ' ' in other_person.name else f'!msg {other_person.name}'
@@ -1162,13 +3824,8 @@ def main():
             await ctx.send("❌ You need to create a profile first! Use `!setup`")
             return
         
-        user_connections = get_user_connections(user_id)
-        
         # Filter only permanent connections
-        permanent_connections = [
-            key for key in user_connections 
-            if active_connections[key].get('permanent', False)
-        ]
+        permanent_connections = active_connections.permanent_connections_of(user_id)
         
         if not permanent_connections:
             await ctx.send("📭 You have no permanent teammates yet!\nUse `!findmatch` and `!connect` to find gaming buddies.")
@@ -1180,39 +3837,50 @@ def main():
             color=discord.Color.green()
         )
         
-        for connection_key in permanent_connections:
-            other_id = get_other_user_id(connection_key, user_id)
-            
-            if other_id not in user_data:
+        teammate_ids = [
+            other_id for other_id in (get_other_user_id(key, user_id) for key in permanent_connections)
+            if other_id in user_data
+        ]
+        members = await user_cache.get_many(teammate_ids)
+        
+        # Profiles and connections can go away while the Discord users are fetched
+        current_person = user_data.get(user_id)
+        for other_id, member in zip(teammate_ids, members):
+            other_person = user_data.get(other_id)
+            connection = active_connections.get(get_connection_key(user_id, other_id))
+            if current_person is None or other_person is None or connection is None:
                 continue
             
-            other_person = user_data[other_id]
-            match_data = calculate_match_score(user_data[user_id], other_person)
-            
-            try:
-                member = await bot.fetch_user(other_id)
-                
-                # Smart formatting for names with spaces
-                msg_cmd = f'!msg "{other_person.name}"' if ' ' in other_person.name else f'!msg {other_person.name}'
-                
-                # Add distance to field
-                distance_text = f" ({match_data['distance_km']} km away)" if match_data['distance_km'] else ""
-                
-                field_value = (
-                    f"@{member.name}\n"
-                    f"🎮 Common Games: {', '.join(match_data['common_games'])}\n"
-                    f"📍 {other_person.location}{distance_text}\n"
-                    f"📝 {other_person.bio[:50]}..." if len(other_person.bio) > 50 else other_person.bio + "\n"
-                    f"💬 `{msg_cmd} <message>`"
-                )
-                
+            if isinstance(member, Exception):
                 embed.add_field(
                     name=f"⭐ {other_person.name}",
-                    value=field_value,
+                    value=f"⚠️ Couldn't load Discord user: {member}",
                     inline=False
                 )
-            except:
-                pass
+                continue
+            
+            match_data = calculate_match_score(current_person, other_person)
+            
+            # Smart formatting for names with spaces
+            msg_cmd = f'!msg "{other_person.name}"' if ' ' in other_person.name else f'!msg {other_person.name}'
+            
+            # Add distance to field
+            distance_text = f" ({match_data['distance_km']} km away)" if match_data['distance_km'] else ""
+            bio_text = f"{other_person.bio[:50]}..." if len(other_person.bio) > 50 else other_person.bio
+            
+            field_value = (
+                f"@{member.name}\n"
+                f"🎮 Common Games: {', '.join(match_data['common_games'])}\n"
+                f"📍 {other_person.location}{distance_text}\n"
+                f"📝 {bio_text}\n"
+                f"💬 `{msg_cmd} <message>`"
+            )
+            
+            embed.add_field(
+                name=f"⭐ {other_person.name}",
+                value=field_value,
+                inline=False
+            )
         
         embed.set_footer(text="Use !removemember @user to remove a teammate")
         
@@ -1270,13 +3938,82 @@ def main():
         )
         
         await ctx.send(embed=embed)
+
+    @bot.command()
+    @commands.is_owner()
+    async def botstats(ctx):
+        """Show command latency and store sizes (bot owner only)"""
+        gauges = store_gauges()
+        if metrics.enabled:
+            sampling = f"Timing {metrics.sample_rate:.0%} of commands"
+        else:
+            sampling = "Counting commands only; set GAMETALK_METRICS_SAMPLE_RATE to time them"
+        embed = discord.Embed(
+            title="📊 GameTalk Bot - Stats",
+            description=(
+                f"👤 {gauges['profiles']} profiles • 🤝 {gauges['connections']} connections\n"
+                f"{sampling}"
+            ),
+            color=discord.Color.dark_grey()
+        )
+        
+        # Slowest commands first; embeds hold at most 25 fields
+        snapshot = metrics.snapshot(gauges)['commands']
+        by_p95 = sorted(snapshot.items(), key=lambda item: item[1]['p95_seconds'] or 0, reverse=True)
+        for name, stats in by_p95[:25]:
+            if not stats['sampled']:
+                embed.add_field(name=f"!{name}", value=f"{stats['calls']} calls", inline=False)
+                continue
+            
+            total = stats['mean_seconds'] * stats['sampled']
+            split = " • ".join(
+                f"{phase} {100 * stats['phase_seconds'].get(phase, 0) / total:.0f}%"
+                for phase in Metrics.PHASES
+            )
+            embed.add_field(
+                name=f"!{name}",
+                value=(
+                    f"{stats['calls']} calls • "
+                    f"p50 {stats['p50_seconds'] * 1000:.1f}ms • "
+                    f"p95 {stats['p95_seconds'] * 1000:.1f}ms • "
+                    f"p99 {stats['p99_seconds'] * 1000:.1f}ms\n"
+                    f"{split}"
+                ),
+                inline=False
+            )
+        
+        await ctx.send(embed=embed)
+    
+    return bot
+
+def main():
+    load_dotenv()
+    
+    configure_matcher(os.getenv('GAMETALK_MATCHER', 'python'))
+    
+    # Fraction of commands to time; at 0 commands are only counted
+    metrics.sample_rate = float(os.getenv('GAMETALK_METRICS_SAMPLE_RATE', '0'))
+    
+    # Profiles and connections persist to SQLite unless GAMETALK_STORAGE=memory
+    if os.getenv('GAMETALK_STORAGE', 'sqlite') == 'sqlite':
+        storage = SQLiteStorage(os.getenv('GAMETALK_DB_PATH', 'gametalk.db'))
+    else:
+        storage = NullStorage()
+    load_storage(storage)
+    collect_photo_garbage(storage)
+    
+    bot = create_bot(storage)
     
     token = os.getenv('DISCORD_TOKEN')
     if not token:
         print("Error: DISCORD_TOKEN environment variable not set")
+        storage.close()
         return
     
-    bot.run(token)
+    try:
+        bot.run(token)
+    finally:
+        storage.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    """Empty profile, connection, index and cache globals for one test"""
+    monkeypatch.setattr(main, "user_data", main.ProfileStore())
+    monkeypatch.setattr(main, "active_connections", main.ConnectionStore())
+    for name in ("game_index", "station_index", "name_index", "username_index", "usernames", "photo_refs"):
+        monkeypatch.setattr(main, name, {})
+    monkeypatch.setattr(main, "match_cache", main.MatchCache())
+    monkeypatch.setattr(main, "match_engine", None)
+    yield
+    main.shutdown_match_engine()
@@ -0,0 +1,85 @@
+"""
+ConnectionStore's adjacency map, permanent counts and version stamps
+against a plain dict of connections.
+"""
+import random
+from datetime import datetime
+
+import main
+
+
+def new_connection(permanent=False):
+    return {'timestamp': datetime.now(), 'user1_decision': None, 'user2_decision': None, 'permanent': permanent}
+
+
+def check_counts(store, connections, user_ids):
+    assert len(store) == len(connections)
+    for user_id in user_ids:
+        mine = {key for key in connections if user_id in key}
+        permanent = {key for key in mine if connections[key]['permanent']}
+        assert set(store.connections_of(user_id)) == mine
+        assert set(store.permanent_connections_of(user_id)) == permanent
+        assert store.connection_count(user_id) == len(mine)
+        assert store.permanent_count(user_id) == len(permanent)
+        assert store.trial_count(user_id) == len(mine) - len(permanent)
+
+
+def test_connection_store_counts_under_churn():
+    rng = random.Random(1)
+    store = main.ConnectionStore()
+    connections = {}
+    user_ids = range(1, 16)
+    
+    for step in range(3000):
+        action = rng.random()
+        if action < 0.4:
+            key = main.get_connection_key(*rng.sample(user_ids, 2))
+            connection = new_connection(permanent=rng.random() < 0.3)
+            store[key] = connection
+            connections[key] = connection
+        elif action < 0.6 and connections:
+            key = rng.choice(list(connections))
+            store.set_permanent(key)
+            connections[key]['permanent'] = True
+        elif action < 0.8 and connections:
+            key = rng.choice(list(connections))
+            del store[key]
+            del connections[key]
+        else:
+            user_id = rng.choice(user_ids)
+            removed = store.remove_user(user_id)
+            expected = {key for key in connections if user_id in key}
+            assert set(removed) == expected
+            for key in expected:
+                del connections[key]
+        
+        if step % 50 == 0:
+            check_counts(store, connections, user_ids)
+    check_counts(store, connections, user_ids)
+
+
+def test_connection_store_versions():
+    store = main.ConnectionStore()
+    key = main.get_connection_key(1, 2)
+    
+    before = store.version(1), store.version(2), store.version(3)
+    store[key] = new_connection()
+    after_add = store.version(1), store.version(2), store.version(3)
+    assert after_add[0] != before[0] and after_add[1] != before[1]
+    assert after_add[2] == before[2]
+    
+    # Decisions don't change who is connected, so stamps stay put
+    store.record_decision(key, 1, 'keep')
+    assert (store.version(1), store.version(2)) == after_add[:2]
+    assert store[key]['user1_decision'] == 'keep'
+    
+    # Replacing the connection and removing it both do
+    store[key] = new_connection(permanent=True)
+    after_replace = store.version(1), store.version(2)
+    assert after_replace != after_add[:2]
+    assert store.permanent_count(1) == store.permanent_count(2) == 1
+    
+    del store[key]
+    assert (store.version(1), store.version(2)) != after_replace
+    assert store.permanent_count(1) == store.permanent_count(2) == 0
+    assert store.connections_of(1) == []
@@ -0,0 +1,101 @@
+"""
+IP geolocation against a local stub of the ipinfo API, and the gridded
+nearest-station search against a brute-force scan.
+"""
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiohttp import web
+
+import main
+
+BISHAN = {"loc": "1.3510,103.8484", "city": "Singapore", "country": "SG"}
+
+
+async def with_stub_api(test):
+    """Run test(base_url, hits) against a local ipinfo stub, then clean up"""
+    hits = {}
+    
+    async def location(request):
+        hits[request.path] = hits.get(request.path, 0) + 1
+        if request.path == "/slow":
+            await asyncio.sleep(1)
+        if request.path == "/garbled":
+            return web.json_response({"loc": "somewhere", "city": "Singapore"})
+        return web.json_response(BISHAN)
+    
+    app = web.Application()
+    app.router.add_get("/{name}", location)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    main.location_cache.clear()
+    try:
+        await test(f"http://127.0.0.1:{port}", hits)
+    finally:
+        await main.close_http_session()
+        await runner.cleanup()
+        main.location_cache.clear()
+
+
+def test_fetch_location_by_ip():
+    async def test(base_url, hits):
+        assert await main.fetch_location_by_ip(f"{base_url}/json") == (1.3510, 103.8484, "Singapore", "SG")
+        assert await main.fetch_nearest_mrt_by_ip(f"{base_url}/json") == ("Bishan", 0.0)
+    
+    asyncio.run(with_stub_api(test))
+
+
+def test_fetch_location_by_ip_timeout():
+    async def test(base_url, hits):
+        assert await main.fetch_location_by_ip(f"{base_url}/slow", timeout=0.1) is None
+        assert f"{base_url}/slow" not in main.location_cache
+    
+    asyncio.run(with_stub_api(test))
+
+
+def test_fetch_location_by_ip_unparseable_loc():
+    async def test(base_url, hits):
+        assert await main.fetch_location_by_ip(f"{base_url}/garbled") is None
+    
+    asyncio.run(with_stub_api(test))
+
+
+def test_fetch_location_by_ip_cache():
+    async def test(base_url, hits):
+        url = f"{base_url}/json"
+        first = await main.fetch_location_by_ip(url)
+        assert await main.fetch_location_by_ip(url) == first
+        assert hits["/json"] == 1
+        
+        # Once the entry expires the API is asked again
+        expires_at, location = main.location_cache[url]
+        main.location_cache[url] = (expires_at - main.LOCATION_CACHE_TTL - 1, location)
+        assert await main.fetch_location_by_ip(url) == first
+        assert hits["/json"] == 2
+    
+    asyncio.run(with_stub_api(test))
+
+
+def test_nearest_mrt_station_matches_brute_force():
+    rng = random.Random(1)
+    for _ in range(2000):
+        # Singapore plus a margin, so some points have no station within max_km
+        lat = rng.uniform(1.0, 1.7)
+        lon = rng.uniform(103.4, 104.3)
+        distance_km, station = min(
+            (main.haversine_distance(lat, lon, *coordinates), station)
+            for station, coordinates in main.MRT_COORDINATES.items()
+        )
+        result = main.nearest_mrt_station(lat, lon, max_km=25)
+        if distance_km > 25:
+            assert result is None
+        else:
+            assert result is not None
+            assert result[1] == distance_km
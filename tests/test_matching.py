@@ -0,0 +1,157 @@
+"""
+Every matching engine against a plain calculate_match_score scan over
+random profile churn, and MatchCache invalidation.
+"""
+import random
+from datetime import datetime
+
+import pytest
+
+import main
+
+# Several spellings of the same games, so normalization is exercised too
+GAMES = [
+    "Valorant", "valorant", " VALORANT ", "Minecraft", "minecraft", "Apex Legends",
+    "apex  legends", "Dota 2", "Chess", "Tetris", "Among Us", "Rocket League",
+]
+
+
+def random_person(rng, stations):
+    return main.Person(
+        f"Player {rng.randrange(1000)}",
+        rng.randint(16, 40),
+        rng.sample(GAMES, rng.randint(0, 4)),
+        rng.choice(stations),
+        "",
+    )
+
+
+def scan_matches(user_id, limit=5):
+    """find_matches the slow way: score everyone with calculate_match_score"""
+    person = main.user_data[user_id]
+    connected_ids = {main.get_other_user_id(key, user_id) for key in main.get_user_connections(user_id)}
+    scored = sorted(
+        (-score, other_id)
+        for other_id, score in (
+            (other_id, main.calculate_match_score(person, other)['score'])
+            for other_id, other in main.user_data.items()
+            if other_id != user_id and other_id not in connected_ids
+        )
+        if score > 0
+    )
+    return len(scored), [(other_id, -negative_score) for negative_score, other_id in scored[:limit]]
+
+
+@pytest.mark.parametrize("matcher", ["python", "numpy", "incremental", "sharded"])
+def test_engines_match_scan_under_churn(stores, monkeypatch, matcher):
+    if matcher == "numpy" and main.np is None:
+        pytest.skip("NumPy is not installed")
+    # Several shards even on a one-CPU machine, so results get merged
+    monkeypatch.setattr(main.os, "cpu_count", lambda: 3)
+    
+    rng = random.Random(f"churn-{matcher}")
+    # A cluster of nearby stations plus unknown locations
+    stations = main.ALL_MRT_STATIONS[:12] + ["", "Somewhere else"]
+    user_ids = range(1, 81)
+    for user_id in user_ids[:40]:
+        main.register_profile(user_id, random_person(rng, stations))
+    main.configure_matcher(matcher)
+    
+    for step in range(1500):
+        action = rng.random()
+        profiled = list(main.user_data)
+        if action < 0.3:
+            main.register_profile(rng.choice(user_ids), random_person(rng, stations))
+        elif action < 0.4 and profiled:
+            main.delete_profile(rng.choice(profiled))
+        elif action < 0.55 and len(profiled) >= 2:
+            user1_id, user2_id = rng.sample(profiled, 2)
+            main.active_connections[main.get_connection_key(user1_id, user2_id)] = {
+                'timestamp': datetime.now(),
+                'user1_decision': None,
+                'user2_decision': None,
+                'permanent': rng.random() < 0.5,
+            }
+        elif action < 0.6 and len(main.active_connections):
+            del main.active_connections[rng.choice(list(main.active_connections.keys()))]
+        elif profiled:
+            user_id = rng.choice(profiled)
+            limit = rng.choice((1, 5))
+            assert main.find_matches(user_id, limit) == scan_matches(user_id, limit), (step, user_id)
+
+
+def far_apart_stations():
+    """Two stations further apart than NEARBY_KM"""
+    return next(
+        (station1, station2)
+        for station1 in main.ALL_MRT_STATIONS
+        for station2 in main.ALL_MRT_STATIONS
+        if main.get_mrt_distance(station1, station2) > 2 * main.NEARBY_KM
+    )
+
+
+def test_match_cache_invalidation(stores):
+    here, far = far_apart_stations()
+    main.register_profile(1, main.Person("A", 20, ["Chess"], here, ""))
+    main.register_profile(2, main.Person("B", 20, ["chess"], far, ""))
+    
+    assert main.find_matches(1) == (1, [(2, 20)])
+    assert len(main.match_cache) == 1
+    
+    # Someone with nothing in common leaves the cached result alone
+    main.register_profile(3, main.Person("C", 20, ["Tetris"], far, ""))
+    assert main.match_cache.get(1, 5) == (1, [(2, 20)])
+    
+    # A new player of the same game invalidates it
+    main.register_profile(4, main.Person("D", 20, [" CHESS"], far, ""))
+    assert main.match_cache.get(1, 5) is None
+    assert main.find_matches(1) == (2, [(2, 20), (4, 20)])
+    
+    # So does a nearby player, and so does dropping the game
+    main.register_profile(5, main.Person("E", 20, ["Tetris"], here, ""))
+    assert main.match_cache.get(1, 5) is None
+    assert main.find_matches(1) == scan_matches(1)
+    main.register_profile(4, main.Person("D", 20, ["Tetris"], far, ""))
+    assert main.match_cache.get(1, 5) is None
+    assert main.find_matches(1) == scan_matches(1)
+    
+    # A new connection of the user changes their connection stamp
+    main.active_connections[main.get_connection_key(1, 2)] = {
+        'timestamp': datetime.now(), 'user1_decision': None, 'user2_decision': None, 'permanent': False,
+    }
+    assert main.match_cache.get(1, 5) is None
+    assert main.find_matches(1) == scan_matches(1)
+    
+    # A different limit, their own profile changing, or deleting a match all miss
+    assert main.match_cache.get(1, 1) is None
+    main.find_matches(1)
+    main.register_profile(1, main.Person("A", 21, ["Chess", "Tetris"], here, ""))
+    assert main.match_cache.get(1, 5) is None
+    main.find_matches(1)
+    main.delete_profile(5)
+    assert main.match_cache.get(1, 5) is None
+    assert main.find_matches(1) == scan_matches(1)
+
+
+def test_match_cache_put_after_change_is_ignored(stores):
+    main.register_profile(1, main.Person("A", 20, ["Chess"], "", ""))
+    main.register_profile(2, main.Person("B", 20, ["Chess"], "", ""))
+    token = main.match_cache.token(1)
+    stale = main.compute_matches(1)
+    # A profile changes while the (possibly awaited) result is being computed
+    main.register_profile(3, main.Person("C", 20, ["Chess"], "", ""))
+    main.match_cache.put(1, 5, main.user_data[1], stale, token)
+    assert main.match_cache.get(1, 5) is None
+
+
+def test_match_cache_evicts_least_recently_used(stores):
+    main.match_cache.max_size = 2
+    for user_id in (1, 2, 3):
+        main.register_profile(user_id, main.Person(f"P{user_id}", 20, [f"Game {user_id}"], "", ""))
+    main.find_matches(1)
+    main.find_matches(2)
+    main.find_matches(1)
+    main.find_matches(3)
+    assert main.match_cache.get(1, 5) is not None
+    assert main.match_cache.get(2, 5) is None
+    assert main.match_cache.get(3, 5) is not None